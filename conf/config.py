@@ -17,6 +17,8 @@ DAEMON_TRUSTED_HOST = 'localhost'
 DAEMON_TRUSTED_PORT = 31397
 DAEMON_TRUSTED_USER = 'user'
 DAEMON_TRUSTED_PASSWORD = 'pass'
+DAEMON_RPC_POOL_SIZE = 2            # Kept-alive HTTP connections to the daemon
+DAEMON_RPC_TIMEOUT = 30             # Seconds, None = no timeout
 
 # ******************** GENERAL SETTINGS ***************
 # Set process name of twistd, much more comfortable if you run multiple processes on one machine
@@ -43,6 +45,11 @@ LOG_RETENTION = 10 # Keep 10 Logs
 # it should be slightly more, say 100-300.
 THREAD_POOL_SIZE = 300
 
+# How many processes use for share PoW verification.
+# None = one per CPU core, 0 = verify in the main process.
+WORKER_PROCESSES = None
+WORKER_TASK_TIMEOUT = 30        # Fail task of a dead worker process after this many seconds
+
 # ******************** TRANSPORTS *********************
 # Hostname or external IP to expose
 HOSTNAME = 'localhost'
@@ -60,6 +67,9 @@ LISTEN_HTTPS_TRANSPORT = None
 LISTEN_WS_TRANSPORT = None
 # Port used for secure WebSocket, 'None' for disabling WSS
 LISTEN_WSS_TRANSPORT = None
+# Join messages to one connection within one reactor iteration into a single write
+# (Twisted TCP transport already does it, see stratum/config_default.py)
+WRITE_COALESCING = False
 
 # Salt used for Block Notify Password
 PASSWORD_SALT = 'some_crazy_string'
@@ -100,12 +110,26 @@ PREVHASH_REFRESH_INTERVAL = 5   # How often to check for new Blocks
 MERKLE_REFRESH_INTERVAL = 60    # How often check memorypool
                                 #   This effectively resets the template and incorporates new transactions.
                                 #   This should be "slow"
+GBT_LONGPOLL = False            # Detect new blocks by long-poll getblocktemplate (BIP 22) if the daemon supports it
+GBT_LONGPOLL_TIMEOUT = 300      # Send the long poll again after this many seconds without a new template
+GBT_LONGPOLL_RETRY = 10         # Wait before a new long poll after failure, prevhash polling is used meanwhile
 
 INSTANCE_ID = 31                # Used for extranonce and needs to be 0-31
 
 # How long before work expires
 WORK_EXPIRE = 180
 
+# New jobs are pushed to this many connections at once, then other requests are served
+BROADCAST_CHUNK_SIZE = 100
+MERKLE_PARALLEL_MIN_BATCH = 500     # Compute merkle roots in worker processes for at least this many connections
+BROADCAST_WORKER_PROCESSES = None   # Processes for broadcast merkle roots, separate from share verification (None = one per core)
+BROADCAST_PRIORITY = 'hashrate'     # Connection order of broadcast: None, 'hashrate' or 'presorted'
+LAZY_WORK_IDLE_TIME = None          # Don't push same-block updates to connections idle for this many seconds (None = push to all)
+BROADCAST_STATS_WINDOW = 20         # Recent broadcasts kept for latency stats (admin get_broadcast_stats)
+JOB_HISTORY_SIZE = 64               # Templates kept for share validation, shares of older jobs are rejected
+JOB_GRACE_TIME = None               # Accept shares on replaced job of the current block for this many seconds (None = whole block)
+SPECULATIVE_TEMPLATES = True        # Broadcast coinbase-only template on new block before getblocktemplate returns
+
 # ******************** Pool Difficulty Settings *********************
 # 13=1 13.693147181=2 14.386294362=4  15.079441543=8 15.772588724=16 16.465735905=32 17.158883086=64 17.852030267=128
 # 18.545177448=256 19.238324629=512 19.93147181=1024 20.624618991=2048
@@ -129,6 +153,20 @@ VDIFF_VARIANCE_PERCENT = 30        # Allow average time to very this % from targ
 # for min or max limits this should be done by your front end software
 ALLOW_EXTERNAL_DIFFICULTY = False 
 
+# ******************** Share Validation *********************
+DUPLICATE_INDEX_SIZE = 1000000  # Max. shares remembered for duplicate detection per block round
+POW_CACHE_SIZE = 100000         # Max. PoW results cached for resubmitted shares
+SHARE_MIN_SHIFT = 14            # Accepted nShift range of submitted shares
+SHARE_MAX_SHIFT = 512           #   (consensus requires nShift >= 14)
+SHARE_MAX_ADDER_SIZE = 64       # Max. length of nAdd in bytes
+SHARE_RECORD_FILE = None        # Record templates and shares for scripts/bench_submit.py
+
+# Trusted workers may send PoW difficulty of the share as 4th param of mining.submit,
+# only a random sample of their shares below the block target is fully verified.
+TRUSTED_WORKERS = []            # Worker names, e.g. ['farm.rig1', ]
+TRUSTED_IPS = []                # IPs of trusted proxies
+TRUSTED_SAMPLE_RATE = 0.1       # Fraction of trusted shares still fully verified
+
 # ******************** Worker Ban Options *********************
 ENABLE_WORKER_STATS = False     # Master stats control disable to reduce server load
 ENABLE_WORKER_BANNING = True    # Enable/disable temporary worker banning 
@@ -4,8 +4,10 @@
 
 import simplejson as json
 import base64
-from twisted.internet import defer
-from twisted.web import client
+import StringIO
+from twisted.internet import defer, reactor
+from twisted.web import client, error
+from twisted.web.http_headers import Headers
 import time
 
 import lib.logger
@@ -13,32 +15,115 @@ log = lib.logger.get_logger('bitcoin_rpc')
 
 class BitcoinRPC(object):
     
-    def __init__(self, host, port, username, password):
+    def __init__(self, host, port, username, password, pool_size=2, timeout=30):
         self.bitcoin_url = 'http://%s:%d' % (host, port)
         self.credentials = base64.b64encode("%s:%s" % (username, password))
-        self.headers = {
-            'Content-Type': 'text/json',
-            'Authorization': 'Basic %s' % self.credentials,
-        }
-        client.HTTPClientFactory.noisy = False
-	self.has_submitblock = False        
-
-    def _call_raw(self, data):
-        client.Headers
-        return client.getPage(
-            url=self.bitcoin_url,
-            method='POST',
-            headers=self.headers,
-            postdata=data,
-        )
+        self.headers = Headers({
+            'Content-Type': ['text/json'],
+            'Authorization': ['Basic %s' % self.credentials],
+        })
+        self.timeout = timeout
+
+        # Keep-alive connections to the daemon are reused by all calls
+        self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = pool_size
+        self.agent = client.Agent(reactor, pool=self.pool)
+
+        # Calls waiting for _flush_batch(), see _call()
+        self.batch_queue = []
+        self.batch_flush = None
+        client._HTTP11ClientFactory.noisy = False
+        self.has_submitblock = False        
+
+    def _call_raw(self, data, timeout=None):
+        '''timeout None is the default timeout, 0 disables it'''
+        d = self.agent.request('POST', self.bitcoin_url, self.headers,
+                               client.FileBodyProducer(StringIO.StringIO(data)))
+        d.addCallback(self._read_response)
+
+        if timeout == None:
+            timeout = self.timeout
+        if timeout:
+            timeout_call = reactor.callLater(timeout, d.cancel)
+            def cancel_timeout(result):
+                if timeout_call.active():
+                    timeout_call.cancel()
+                return result
+            d.addBoth(cancel_timeout)
+        return d
+
+    def _read_response(self, response):
+        d = client.readBody(response)
+        if response.code != 200:
+            # Same failure as getPage used to raise, e.g. "500 Internal Server Error"
+            def raise_error(body):
+                raise error.Error(response.code, response.phrase, body)
+            d.addCallback(raise_error)
+        return d
+
+    def close(self):
+        return self.pool.closeCachedConnections()
            
-    def _call(self, method, params):
+    def _call(self, method, params, batch=False, timeout=None):
+        '''With batch, the call is sent together with other batched calls
+        issued in the same reactor iteration. Use it for calls which
+        can wait, never for getblocktemplate or submitblock.
+        timeout overrides the default one, see _call_raw().'''
+        if batch:
+            d = defer.Deferred()
+            self.batch_queue.append((method, params, d))
+            if self.batch_flush == None:
+                self.batch_flush = reactor.callLater(0, self._flush_batch)
+            return d
+
         return self._call_raw(json.dumps({
                 'jsonrpc': '2.0',
                 'method': method,
                 'params': params,
                 'id': '1',
-            }))
+            }), timeout)
+
+    def call_batch(self, calls):
+        '''Sends calls, list of (method, params), in one JSON-RPC batch request.
+        Returns list of Deferreds fired with raw response of each call,
+        the same _call() returns.'''
+        ds = [ defer.Deferred() for _ in calls ]
+        d = self._call_raw(json.dumps([ {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i}
+                                        for (i, (method, params)) in enumerate(calls) ]))
+        d.addCallback(self._fan_out, ds)
+        d.addErrback(self._fail_batch, ds)
+        return ds
+
+    def _fan_out(self, resp, ds):
+        responses = dict([ (r['id'], r) for r in json.loads(resp) ])
+        for (i, d) in enumerate(ds):
+            if i not in responses:
+                d.errback(Exception("Batch response is missing call %d" % i))
+            elif responses[i].get('error') != None:
+                # Same failure as the daemon's HTTP 500 of a single call
+                d.errback(error.Error(500, 'Internal Server Error', json.dumps(responses[i])))
+            else:
+                d.callback(json.dumps(responses[i]))
+
+    def _fail_batch(self, failure, ds):
+        for d in ds:
+            if not d.called:
+                d.errback(failure)
+
+    def _flush_batch(self):
+        self.batch_flush = None
+        queue = self.batch_queue
+        self.batch_queue = []
+
+        if len(queue) == 1:
+            (method, params, d) = queue[0]
+            self._call(method, params).chainDeferred(d)
+            return
+
+        log.debug("Batch of %d RPC calls" % len(queue))
+        ds = self.call_batch([ (m, p) for (m, p, _) in queue ])
+        for (batch_d, (_, _, call_d)) in zip(ds, queue):
+            batch_d.chainDeferred(call_d)
 
     @defer.inlineCallbacks
     def submitblock(self, block_hex, txs, block_hash_hex):
@@ -64,11 +149,17 @@ class BitcoinRPC(object):
 
     @defer.inlineCallbacks
     def getinfo(self):
-         resp = (yield self._call('getinfo', []))
+         resp = (yield self._call('getinfo', [], batch=True))
          defer.returnValue(json.loads(resp)['result'])
     
     @defer.inlineCallbacks
-    def getblocktemplate(self):
+    def getblocktemplate(self, longpollid=None, timeout=None):
+        '''With longpollid (BIP 22), daemon holds the request until
+        the template changes, use long enough timeout.'''
+        if longpollid != None:
+            resp = (yield self._call('getblocktemplate', [{'longpollid': longpollid}], timeout=timeout))
+            defer.returnValue(json.loads(resp)['result'])
+
         try:
             resp = (yield self._call('getblocktemplate', [{}]))
             defer.returnValue(json.loads(resp)['result'])
@@ -99,12 +190,12 @@ class BitcoinRPC(object):
         
     @defer.inlineCallbacks
     def validateaddress(self, address):
-        resp = (yield self._call('validateaddress', [address,]))
+        resp = (yield self._call('validateaddress', [address,], batch=True))
         defer.returnValue(json.loads(resp)['result'])
 
     @defer.inlineCallbacks
     def getdifficulty(self):
-        resp = (yield self._call('getdifficulty', []))
+        resp = (yield self._call('getdifficulty', [], batch=True))
         defer.returnValue(json.loads(resp)['result'])
 
     @defer.inlineCallbacks
@@ -118,3 +209,23 @@ class BitcoinRPC(object):
             log.info("Cannot find block for %s" % block_hash_hex)
             defer.returnValue(False)
 
+def _test():
+    rpc = BitcoinRPC('127.0.0.1', 8332, 'user', 'pass')
+    rpc._call_raw = lambda data, timeout=None: defer.succeed(json.dumps([
+        {'id': 0, 'result': 12.5, 'error': None},
+        {'id': 1, 'result': None, 'error': {'code': -5, 'message': 'Invalid address'}},
+    ]))
+
+    results = []
+    for d in rpc.call_batch([('getdifficulty', []), ('validateaddress', ['x'])]):
+        d.addCallbacks(lambda resp: results.append(json.loads(resp)['result']),
+                       lambda failure: results.append(failure.value))
+
+    # Successful call gets its response, failed one the same error as _call()
+    assert results[0] == 12.5
+    assert isinstance(results[1], error.Error) and results[1].status == '500'
+    assert json.loads(results[1].response)['error']['code'] == -5
+    print "OK"
+
+if __name__ == '__main__':
+    _test()
@@ -1,5 +1,6 @@
 import StringIO
 import binascii
+import json
 import struct
 
 import util
@@ -10,6 +11,7 @@ import lib.logger
 log = lib.logger.get_logger('block_template')
 
 import settings
+from hashlib import sha256
 
 class BlockTemplate(halfnode.CBlock):
     '''Template is used for generating new jobs for clients.
@@ -31,15 +33,36 @@ class BlockTemplate(halfnode.CBlock):
         self.curtime = 0
         self.target = 0
         self.merkletree = None
+        self.coinbase_midstate = None
                 
         self.broadcast_args = []
-        self.submits = [] 
+        self.notify_template = None
+        self.notify_difficulties = {}
+        self.span = None            # lib.broadcast_stats.BroadcastSpan
+        self.transactions = {}      # txid -> (CTransaction, binary hash)
+        self.body_head_hex = ''     # Hex of transaction count, see serialize_block_body()
+        self.body_tail_hex = ''     # Hex of raw transactions following the coinbase
                 
-    def fill_from_rpc(self, data):
-        '''Convert getblocktemplate result into BlockTemplate instance'''
+    def fill_from_rpc(self, data, previous=None):
+        '''Convert getblocktemplate result into BlockTemplate instance.
+        Merkle tree and parsed transactions are reused from previous template, if given.'''
         
-        txhashes = [None] + [ util.ser_uint256(int(t['hash'], 16)) for t in data['transactions'] ]
-        mt = merkletree.MerkleTree(txhashes)
+        # Transactions still in mempool were parsed already, mined
+        # and dropped ones are forgotten with the previous template
+        known = previous.transactions if previous != None else {}
+        self.transactions = {}
+        entries = []
+        for t in data['transactions']:
+            entry = known.get(t['hash'])
+            if entry == None:
+                tx = halfnode.CTransaction()
+                tx.deserialize(StringIO.StringIO(binascii.unhexlify(t['data'])))
+                entry = (tx, util.ser_uint256(int(t['hash'], 16)))
+            self.transactions[t['hash']] = entry
+            entries.append(entry)
+
+        txhashes = [None] + [ txhash for (_, txhash) in entries ]
+        mt = merkletree.IncrementalMerkleTree(txhashes, previous.merkletree if previous != None else None)
         coinbase = CoinbaseTransaction(self.timestamper, self.coinbaser, data['coinbasevalue'],
                                               data['coinbaseaux']['flags'], data['height'],
                                               settings.COINBASE_EXTRAS)
@@ -52,16 +75,17 @@ class BlockTemplate(halfnode.CBlock):
         self.hashMerkleRoot = 0
         self.nTime = 0
         self.nNonce = 0
-        self.vtx = [ coinbase, ]
-        
-        for tx in data['transactions']:
-            t = halfnode.CTransaction()
-            t.deserialize(StringIO.StringIO(binascii.unhexlify(tx['data'])))
-            self.vtx.append(t)
+        self.vtx = [ coinbase, ] + [ tx for (tx, _) in entries ]
+
+        # Raw transactions from gapcoind are passed through to submitblock
+        self.body_head_hex = binascii.hexlify(util.ser_compact_size(len(self.vtx)))
+        self.body_tail_hex = ''.join([ t['data'] for t in data['transactions'] ])
             
         self.curtime = data['curtime']
         self.timedelta = self.curtime - int(self.timestamper.time()) 
         self.merkletree = mt
+        # SHA-256 state after the fixed part of coinbase, see coinbase_hash()
+        self.coinbase_midstate = sha256(coinbase._serialized[0])
         self.target = int(data['bits'], 16)
         self.network_diff = round(float(self.target) / float(pow(2, 48)), 8)
         log.info("Block: %i network difficulty: %0.8f" % (self.height, self.network_diff))
@@ -71,15 +95,8 @@ class BlockTemplate(halfnode.CBlock):
         self.prevhash_hex = "%064x" % self.hashPrevBlock
         
         self.broadcast_args = self.build_broadcast_args()
+        self.notify_template = self.build_notify_template()
                 
-    def register_submit(self, data):
-        '''Client submitted some solution. Let's register it to
-        prevent double submissions.'''
-        if data not in self.submits:
-            self.submits.append(data)
-            return True
-        return False
-            
     def build_broadcast_args(self):
         job_id = self.job_id
         prevhash = binascii.hexlify(self.prevhash_bin)
@@ -90,11 +107,46 @@ class BlockTemplate(halfnode.CBlock):
         #log.info("%s %s %s %s %s %s" % (job_id, prevhash, version, nbits, ntime, clean_jobs))
         return (job_id, prevhash, version, nbits, ntime, clean_jobs)
 
+    def build_notify_template(self):
+        '''Pre-render JSON of the job pushed to the clients
+        (see Protocol.writeJsonGetWorkResponse). Only merkle root
+        and difficulty differ between connections, render_notify()
+        splices them between the fixed parts.'''
+        (_, prevhash, version, nbits, ntime, _) = self.broadcast_args
+        return ('{"id": 0, "error": null, "result": {"data": "' + version + prevhash,
+                ntime + nbits + '", "difficulty": ',
+                '}}\n')
+
+    def render_notify(self, merkle_root, difficulty):
+        '''Serialized job for the connection, merkle_root in hex'''
+        (head, middle, tail) = self.notify_template
+        rendered = self.notify_difficulties.get(difficulty)
+        if rendered == None:
+            # Few distinct difficulties are used by all the connections
+            rendered = json.dumps(difficulty)
+            self.notify_difficulties[difficulty] = rendered
+        return head + merkle_root + middle + rendered + tail
+
     def serialize_coinbase(self, extranonce1, extranonce2):
         '''Serialize coinbase with given extranonce1 and extranonce2
         in binary form'''
         (part1, part2) = self.vtx[0]._serialized
         return part1 + extranonce1 + extranonce2 + part2
+
+    def serialize_block_body(self, extranonce1, extranonce2):
+        '''Hex of all block transactions, same as util.ser_vector(self.vtx)
+        with given extranonces in coinbase. Only coinbase is serialized,
+        the rest is spliced from raw getblocktemplate data.'''
+        return self.body_head_hex + binascii.hexlify(self.serialize_coinbase(extranonce1, extranonce2)) + \
+               self.body_tail_hex
+
+    def coinbase_hash(self, extranonce1, extranonce2):
+        '''Double SHA-256 of serialize_coinbase(extranonce1, extranonce2).
+        Hashing continues from the state precomputed for part1,
+        so only extranonces and part2 are processed.'''
+        h = self.coinbase_midstate.copy()
+        h.update(extranonce1 + extranonce2 + self.vtx[0]._serialized[1])
+        return sha256(h.digest()).digest()
     
     def check_ntime(self, ntime):
         '''Check for ntime restrictions.'''
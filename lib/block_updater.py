@@ -16,9 +16,10 @@ class BlockUpdater(object):
         with ./litecoind -blocknotify will go wrong. 
     '''
     
-    def __init__(self, registry, bitcoin_rpc):
+    def __init__(self, registry, bitcoin_rpc, longpoller=None):
         self.bitcoin_rpc = bitcoin_rpc
         self.registry = registry
+        self.longpoller = longpoller
         self.clock = None
         self.schedule()
                         
@@ -37,28 +38,86 @@ class BlockUpdater(object):
     @defer.inlineCallbacks
     def run(self):
         update = False
+        is_new_block = False
        
         try:             
             if self.registry.last_block:
                 current_prevhash = "%064x" % self.registry.last_block.hashPrevBlock
             else:
                 current_prevhash = None  
-            log.debug("Checking for new block.")
-            prevhash = util.rev((yield self.bitcoin_rpc.prevhash()))
+            if self.longpoller != None and self.longpoller.active:
+                # New blocks come by the parked long-poll request
+                prevhash = current_prevhash
+            else:
+                log.debug("Checking for new block.")
+                prevhash = util.rev((yield self.bitcoin_rpc.prevhash()))
+
             if prevhash and prevhash != current_prevhash:
                 log.info("New block! Prevhash: %s" % prevhash)
                 update = True
+                is_new_block = True
             
             elif Interfaces.timestamper.time() - self.registry.last_update >= settings.MERKLE_REFRESH_INTERVAL:
                 log.info("Merkle update! Prevhash: %s" % prevhash)
                 update = True
                 
             if update:
-                self.registry.update_block()
+                self.registry.update_block(is_new_block, prevhash=prevhash if is_new_block else None)
 
         except Exception:
             log.exception("UpdateWatchdog.run failed")
         finally:
             self.schedule()
 
-    
+class LongPoller(object):
+    '''
+        Keeps getblocktemplate long-poll request (BIP 22) parked in the daemon.
+        It returns as soon as the template changes and the result goes
+        straight to the registry. While the request is parked, BlockUpdater
+        doesn't poll for prevhash, it takes over again when the daemon
+        doesn't support long polling or the request fails.
+    '''
+
+    def __init__(self, registry, bitcoin_rpc):
+        self.bitcoin_rpc = bitcoin_rpc
+        self.registry = registry
+        self.active = False
+
+    def start(self):
+        data = self.registry.last_data
+        if data == None:
+            # First template is not fetched yet
+            reactor.callLater(1, self.start)
+            return
+        self._poll(data.get('longpollid'))
+
+    def _poll(self, longpollid):
+        if longpollid == None:
+            log.warning("Daemon doesn't support long polling, using timer polling only")
+            self.active = False
+            return
+
+        self.active = True
+        d = self.bitcoin_rpc.getblocktemplate(longpollid, settings.GBT_LONGPOLL_TIMEOUT)
+        d.addCallback(self._on_template)
+        d.addErrback(self._failed)
+
+    def _on_template(self, data):
+        try:
+            log.info("Long poll returned template for %s" % data['previousblockhash'])
+            self.registry.on_longpoll(data)
+        except Exception:
+            log.exception("Processing of long poll template failed")
+
+        self._poll(data.get('longpollid'))
+
+    def _failed(self, failure):
+        if failure.check(defer.CancelledError):
+            # Timeout, the template didn't change meanwhile
+            log.debug("Long poll timed out, polling again")
+            self.start()
+            return
+
+        log.error("Long poll failed: %s" % failure.getErrorMessage())
+        self.active = False
+        reactor.callLater(settings.GBT_LONGPOLL_RETRY, self.start)
@@ -0,0 +1,94 @@
+'''
+    Timing of the way from block notification to the clients.
+
+    Every template carries BroadcastSpan with timestamps of phases:
+
+      notify    - TemplateRegistry.update_block() called (blocknotify or timer)
+      rpc       - getblocktemplate result received
+      template  - block template built (fill_from_rpc)
+      merkle    - merkle roots of all connections computed
+      broadcast - last job written to the transport
+
+    Delay between notify and the job write of every connection is counted
+    in a rolling histogram of the last few new block broadcasts.
+'''
+
+import time
+import collections
+
+import lib.logger
+log = lib.logger.get_logger('broadcast_stats')
+
+PHASES = ('notify', 'rpc', 'template', 'merkle', 'broadcast')
+
+# Upper bounds of histogram buckets in milliseconds, last one catches the rest
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, None)
+LABELS = [ '<=%d' % bound if bound != None else '>%d' % BUCKETS[-2] for bound in BUCKETS ]
+
+class BroadcastSpan(object):
+    def __init__(self, notify_time):
+        self.times = {'notify': notify_time}
+        self.job_id = None
+        self.is_new_block = False
+        self.connections = 0
+        self.counts = [0] * len(BUCKETS)
+
+    def mark(self, phase):
+        self.times[phase] = time.time()
+
+    def add_latency(self):
+        '''Count job written to one connection'''
+        elapsed = (time.time() - self.times['notify']) * 1000
+        for (i, bound) in enumerate(BUCKETS):
+            if bound == None or elapsed <= bound:
+                self.counts[i] += 1
+                break
+        self.connections += 1
+
+    def as_dict(self):
+        start = self.times['notify']
+        return {'job_id': self.job_id, 'new_block': self.is_new_block,
+                'connections': self.connections,
+                'phases': [ (phase, round((self.times[phase] - start) * 1000, 3))
+                            for phase in PHASES if phase in self.times ]}
+
+class BroadcastStats(object):
+    def __init__(self, window):
+        self.spans = collections.deque(maxlen=window)
+
+    def start(self):
+        return BroadcastSpan(time.time())
+
+    def finish(self, span):
+        span.mark('broadcast')
+        self.spans.append(span)
+        log.info("Job %s: %s" % (span.job_id,
+                 ', '.join([ "%s %.01f ms" % p for p in span.as_dict()['phases'][1:] ])))
+
+    def get_histogram(self):
+        '''Merged histogram of new block broadcasts in the window'''
+        counts = [0] * len(BUCKETS)
+        for span in self.spans:
+            if span.is_new_block:
+                counts = [ a + b for (a, b) in zip(counts, span.counts) ]
+        return counts
+
+    def percentile(self, counts, p):
+        '''Label of the bucket containing p-th percentile'''
+        total = sum(counts)
+        if not total:
+            return None
+        limit = total * p / 100.0
+        seen = 0
+        for (label, count) in zip(LABELS, counts):
+            seen += count
+            if seen >= limit:
+                return label
+        return None
+
+    def get_stats(self):
+        counts = self.get_histogram()
+        return {'spans': [ span.as_dict() for span in self.spans ],
+                'histogram': zip(LABELS, counts),
+                'p50': self.percentile(counts, 50),
+                'p99': self.percentile(counts, 99)}
@@ -29,6 +29,15 @@ LOG_RETENTION = 10 # Keep 10 Logs
 # it should be slightly more, say 100-300.
 THREAD_POOL_SIZE = 300
 
+# How many processes use for share PoW verification.
+# None means one process per CPU core, 0 verifies shares
+# directly in the main process (blocking other connections).
+WORKER_PROCESSES = None
+
+# Task of a worker process fails after this many seconds, so a share
+# isn't stuck forever when the process dies (e.g. crash in gapcoin_hash).
+WORKER_TASK_TIMEOUT = 30
+
 # RPC call throws TimeoutServiceException once total time since request has been
 # placed (time to delivery to client + time for processing on the client)
 # crosses _TOTAL (in second).
@@ -101,6 +110,11 @@ DAEMON_TRUSTED_PORT = 8332 # RPC port
 DAEMON_TRUSTED_USER = 'stratum'
 DAEMON_TRUSTED_PASSWORD = '***somepassword***'
 
+# Number of kept-alive HTTP connections to the daemon's RPC
+# and timeout (sec) of one RPC call, None = no timeout.
+DAEMON_RPC_POOL_SIZE = 2
+DAEMON_RPC_TIMEOUT = 30
+
 # ******************** OTHER CORE SETTINGS *********************
 # Use "echo -n '<yourpassword>' | sha256sum | cut -f1 -d' ' "
 # for calculating SHA256 of your preferred password
@@ -173,4 +187,86 @@ DB_STATS_AVG_TIME = 300     # When using the DATABASE_EXTEND option, average spe
                 #   Note: this is also how often it updates
 DB_USERCACHE_TIME = 600     # How long the usercache is good for before we refresh
 
-
+# ******************** SHARE VALIDATION *********************
+
+# How many share digests remember for duplicate detection
+# in one block round (about 100 bytes of RAM per share).
+DUPLICATE_INDEX_SIZE = 1000000
+
+# How many computed PoW results keep for repeated submissions
+# of the same solution (reconnecting miners, retrying proxies).
+# Only accepted shares are remembered by the duplicate index, so
+# resubmitted low shares are answered from this cache.
+POW_CACHE_SIZE = 100000
+
+# Accepted range of nShift in submitted shares and the maximum length
+# of nAdd in bytes. Shares out of range are rejected before the expensive
+# primality test. Consensus allows nShift >= 14 and nAdd < 2^nShift.
+SHARE_MIN_SHIFT = 14
+SHARE_MAX_SHIFT = 512
+SHARE_MAX_ADDER_SIZE = 64
+
+# Record block templates and submitted shares into this file
+# for offline benchmarking (scripts/bench_submit.py). None disables it.
+SHARE_RECORD_FILE = None
+
+# Trusted workers (names or IPs of own farm behind a trusted proxy)
+# may send PoW difficulty of the share as 4th parameter of mining.submit.
+# Only TRUSTED_SAMPLE_RATE of their shares below the block target is fully
+# verified, the rest is credited by the claim. Worker failing a sampled check
+# is flagged and verified fully from then on.
+TRUSTED_WORKERS = []
+TRUSTED_IPS = []
+TRUSTED_SAMPLE_RATE = 0.1
+
+# ******************** BROADCAST *********************
+
+# New jobs are pushed to this many connections at once,
+# then the reactor can process other requests.
+BROADCAST_CHUNK_SIZE = 100
+
+# Merkle roots for at least this many connections are computed
+# by worker processes (BROADCAST_WORKER_PROCESSES), smaller batches inline.
+MERKLE_PARALLEL_MIN_BATCH = 500
+
+# Worker processes for merkle roots of job broadcasts. They are separate
+# from WORKER_PROCESSES, so new block broadcast never waits behind queued
+# share verifications. None = one per CPU core, 0 = compute in the main process.
+BROADCAST_WORKER_PROCESSES = None
+
+# Order of connections in job broadcast:
+#   None        - arbitrary order
+#   'hashrate'  - sorted by estimated hashrate (see share limiter), biggest first
+#   'presorted' - like 'hashrate', but sorted after each broadcast for the next one,
+#                 so no sorting delays the new block. New connections go last.
+BROADCAST_PRIORITY = 'hashrate'
+
+# Connections without submit or mining.request for this many seconds
+# are idle. They don't get updates of the current block pushed, they keep
+# mining the previous job of the block (still valid, see JOB_GRACE_TIME)
+# until their next mining.request. New block is pushed to all connections.
+# None disables.
+LAZY_WORK_IDLE_TIME = None
+
+# Number of recent broadcasts kept for mining.get_broadcast_stats
+BROADCAST_STATS_WINDOW = 20
+
+# Number of recent templates kept for share validation. Shares of older
+# jobs are rejected, this is also the limit of templates held in memory.
+JOB_HISTORY_SIZE = 64
+
+# Shares on a replaced job of the current block are accepted for this
+# many seconds after the replacement. None = until the block changes.
+JOB_GRACE_TIME = None
+
+# On new block with known hash (blocknotify.sh --block, or detected
+# by polling) broadcast coinbase-only template right away, full
+# template follows when getblocktemplate returns.
+SPECULATIVE_TEMPLATES = True
+
+# Keep long-poll getblocktemplate (BIP 22) request parked in the daemon
+# for instant new block detection, prevhash polling is used only when
+# the daemon doesn't support it. Takes one of DAEMON_RPC_POOL_SIZE connections.
+GBT_LONGPOLL = False
+GBT_LONGPOLL_TIMEOUT = 300      # Seconds, request is then sent again (0 = wait as long as the daemon holds it)
+GBT_LONGPOLL_RETRY = 10         # Seconds before new long poll after failure
@@ -0,0 +1,57 @@
+import lib.logger
+log = lib.logger.get_logger('job_ring')
+
+class JobRing(object):
+    '''Last size block templates indexed by job_id. Job ids are
+    hex encoded generation numbers (see JobIdGenerator), so the slot
+    of a job and its validity are checked in constant time.
+
+    Job is valid when it is still in the ring, belongs to the current
+    prevhash and was replaced by a newer template less than grace_time
+    seconds ago (None = valid until the prevhash changes).'''
+
+    def __init__(self, size, grace_time):
+        self.size = size
+        self.grace_time = grace_time
+        self.slots = [None] * size      # (generation, template, replaced_at)
+        self.current = None             # Generation of the newest template
+        self.block_start = None         # First generation of the current prevhash
+
+    def add(self, template, is_new_block, now):
+        '''Store template, it has to have higher job_id than the previous ones'''
+        generation = int(template.job_id, 16)
+
+        if self.current != None:
+            # Grace time of the replaced job starts now
+            (gen, previous, _) = self.slots[self.current % self.size]
+            self.slots[self.current % self.size] = (gen, previous, now)
+
+        if is_new_block or self.block_start == None:
+            self.block_start = generation
+
+        # Overwrites the oldest template, so it can be freed
+        self.slots[generation % self.size] = (generation, template, None)
+        self.current = generation
+
+    def get(self, job_id, now):
+        '''Returns template of valid job or None'''
+        try:
+            generation = int(job_id, 16)
+        except (TypeError, ValueError):
+            return None
+
+        slot = self.slots[generation % self.size]
+        if slot == None or slot[0] != generation:
+            log.info("Job %s is not in job history" % job_id)
+            return None
+
+        if generation < self.block_start:
+            log.info("Job %s is from previous block" % job_id)
+            return None
+
+        replaced_at = slot[2]
+        if replaced_at != None and self.grace_time != None and now - replaced_at > self.grace_time:
+            log.info("Job %s was replaced %d sec ago" % (job_id, now - replaced_at))
+            return None
+
+        return slot[1]
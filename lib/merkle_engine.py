@@ -0,0 +1,46 @@
+import struct
+
+from twisted.internet import defer
+
+from worker_pool import merkle_roots
+
+import lib.logger
+log = lib.logger.get_logger('merkle_engine')
+
+class MerkleRootEngine(object):
+    '''Computes merkle roots of one template for a batch of extranonce1
+    values. Big batches are split across worker processes, small
+    ones (e.g. single mining.request) are computed inline.'''
+
+    extranonce2 = struct.pack('>L', 0)
+
+    def __init__(self, worker_pool, min_batch):
+        self.worker_pool = worker_pool
+        self.min_batch = min_batch
+
+    def compute(self, template, extranonces):
+        '''Returns Deferred fired with packed merkle roots
+        (32 bytes per extranonce1, in the same order).'''
+        if not extranonces:
+            return defer.succeed('')
+
+        processes = self.worker_pool.processes
+        if processes < 2 or len(extranonces) < self.min_batch:
+            # Coinbase hashing starts from the midstate cached by template
+            return defer.succeed(''.join([ template.merkletree.withFirst(template.coinbase_hash(e, self.extranonce2))
+                                           for e in extranonces ]))
+
+        (part1, part2) = template.vtx[0]._serialized
+        steps = template.merkletree._steps
+        size = len(extranonces[0])
+        packed = ''.join(extranonces)
+
+        # One chunk per worker process
+        chunk = ((len(extranonces) + processes - 1) // processes) * size
+        dl = [ self.worker_pool.apply(merkle_roots, part1, part2, self.extranonce2, steps,
+                                      packed[i:i + chunk], size)
+               for i in xrange(0, len(packed), chunk) ]
+
+        d = defer.gatherResults(dl, consumeErrors=True)
+        d.addCallback(''.join)
+        return d
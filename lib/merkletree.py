@@ -63,6 +63,55 @@ class MerkleTree:
     def merkleRoot(self):
         return self.withFirst(self.data[0])
 
+class IncrementalMerkleTree(MerkleTree):
+    '''MerkleTree reusing interior hashes of the previous tree.
+    Hash of every pair of nodes is remembered and looked up by the
+    content of the pair. Appended transactions rehash only the right
+    edge of the tree. Insertion or removal shifts all nodes behind it,
+    so only the part in front of it (and pairs which kept their
+    alignment) is reused, removal near the start rehashes nearly all.'''
+
+    def __init__(self, data, previous=None):
+        if isinstance(previous, IncrementalMerkleTree):
+            self._previous = previous._pairs
+        else:
+            self._previous = {}
+        self._pairs = {}
+        self.hashed = 0
+        MerkleTree.__init__(self, data)
+
+    def recalculate(self, detailed=False):
+        if detailed:
+            return MerkleTree.recalculate(self, detailed)
+
+        previous = self._previous
+        pairs = {}
+        hashed = 0
+        L = self.data
+        Ll = len(L)
+        steps = []
+        while Ll > 1:
+            steps.append(L[1])
+            if Ll % 2:
+                L = L + [L[-1]]
+            level = [None]
+            for i in range(2, Ll, 2):
+                pair = L[i] + L[i + 1]
+                h = previous.get(pair)
+                if h == None:
+                    h = doublesha(pair)
+                    hashed += 1
+                pairs[pair] = h
+                level.append(h)
+            L = level
+            Ll = len(L)
+        self._steps = steps
+        self.detail = None
+        self.hashed = hashed
+        # Don't keep the whole chain of previous trees alive
+        self._previous = None
+        self._pairs = pairs
+
 # MerkleTree tests
 def _test():
     import binascii
@@ -99,5 +148,21 @@ def _test():
     print x
     print time.time() - s
 
+    # Incremental tree gives the same root, rehashing only the changed paths
+    coinbasehash = doublesha('coinbase')
+    txes = [None] + [doublesha(chr(i)) for i in range(100)]
+    mt = IncrementalMerkleTree(txes)
+    assert(mt.hashed == 97)
+
+    for (data, hashed) in (
+            (txes + [doublesha('new')], 6),                     # Append
+            (txes[:90] + txes[91:], 15),                        # Removal near the end
+            (txes[:90] + txes[92:], 10),                        # Removal keeping alignment
+            (txes[:90] + [doublesha('new')] + txes[90:], 17),   # Insertion near the end
+            (txes[:10] + txes[11:], 90)):                       # Removal near the start
+        mt2 = IncrementalMerkleTree(data, mt)
+        assert(mt2.withFirst(coinbasehash) == MerkleTree(data).withFirst(coinbasehash))
+        assert(mt2.hashed == hashed)
+
 if __name__ == '__main__':
     _test()
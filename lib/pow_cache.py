@@ -0,0 +1,45 @@
+import collections
+
+import lib.logger
+log = lib.logger.get_logger('pow_cache')
+
+class PowResultCache(object):
+    '''LRU cache of PoW difficulty computed for share digests
+    (see DuplicateShareIndex.digest). Repeated submissions of the same
+    solution are answered without repeating the primality test.
+    Cache is dropped on every new prevhash.'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.prevhash = None
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self, prevhash):
+        if self.prevhash != None:
+            log.info("PoW cache for %s: %d hits, %d misses" % (self.prevhash, self.hits, self.misses))
+        self.prevhash = prevhash
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        '''Returns cached PoW difficulty or None'''
+        try:
+            hash_int = self.results.pop(digest)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # Move to the most recently used end
+        self.results[digest] = hash_int
+        self.hits += 1
+        return hash_int
+
+    def put(self, digest, hash_int):
+        if digest in self.results:
+            del self.results[digest]
+        elif len(self.results) >= self.max_size:
+            self.results.popitem(last=False)
+        self.results[digest] = hash_int
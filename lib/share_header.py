@@ -0,0 +1,74 @@
+import struct
+import binascii
+
+from lib.exceptions import SubmitException
+
+# Layout of Gapcoin block header, see CBlock cast in submitblock (rpcmining.cpp)
+#   nVersion(4) hashPrevBlock(32) hashMerkleRoot(32) nTime(4)
+#   nDifficulty(8) nNonce(4) nShift(2) nAdd(variable, up to the end)
+TAIL_FORMAT = '<IQIH'
+PREVHASH_OFFSET = 4
+MERKLEROOT_OFFSET = 36
+TAIL_OFFSET = 68
+HASH_SIZE = 84      # nVersion..nNonce, input of the block hash
+HEADER_SIZE = 86    # fixed part of the header, nAdd follows
+
+# Consensus rules of PoW::valid() in gapcoind: 2^nShift has to be
+# at least 2^14 and nAdd (little endian) has to be lower than 2^nShift
+MIN_SHIFT = 14
+MAX_SHIFT = 0xffff  # nShift is uint16
+
+class ShareHeader(object):
+    '''Submitted Gapcoin header decoded once from hex.
+    Hashes and nAdd are memoryview slices of the same buffer,
+    so later stages don't need to copy or re-slice the hex string.'''
+
+    __slots__ = ('hex', 'raw', 'buf', 'nVersion', 'nTime', 'nDifficulty', 'nNonce', 'nShift')
+
+    def __init__(self, data):
+        try:
+            raw = binascii.unhexlify(data)
+        except (TypeError, UnicodeEncodeError):
+            raise SubmitException("Malformed share data")
+
+        if len(raw) <= HEADER_SIZE:
+            # submitblock rejects headers without nAdd
+            raise SubmitException("Malformed share data")
+
+        self.hex = str(data)
+        self.raw = raw
+        self.buf = memoryview(raw)
+        self.nVersion = struct.unpack_from('<i', raw, 0)[0]
+        (self.nTime, self.nDifficulty, self.nNonce, self.nShift) = \
+            struct.unpack_from(TAIL_FORMAT, raw, TAIL_OFFSET)
+
+    @property
+    def hashPrevBlock(self):
+        return self.buf[PREVHASH_OFFSET:MERKLEROOT_OFFSET]
+
+    @property
+    def hashMerkleRoot(self):
+        return self.buf[MERKLEROOT_OFFSET:TAIL_OFFSET]
+
+    @property
+    def nAdd(self):
+        return self.buf[HEADER_SIZE:]
+
+    @property
+    def header(self):
+        '''Part of the header covered by the block hash'''
+        return self.buf[:HASH_SIZE]
+
+    def adder_bits(self):
+        '''Bit length of nAdd, ignoring the leading (most significant) zero bytes'''
+        raw = self.raw
+        i = len(raw) - 1
+        while i >= HEADER_SIZE and raw[i] == '\x00':
+            i -= 1
+        if i < HEADER_SIZE:
+            return 0
+        return (i - HEADER_SIZE) * 8 + len(bin(ord(raw[i]))) - 2
+
+    def merkle_root_hex(self):
+        '''Merkle root in the same form as registered in job_log'''
+        return binascii.hexlify(self.hashMerkleRoot)
@@ -0,0 +1,63 @@
+import collections
+from hashlib import sha256
+
+import lib.logger
+log = lib.logger.get_logger('share_index')
+
+class DuplicateShareIndex(object):
+    '''Remembers compact digests of submitted solutions (header + nAdd)
+    for the current prevhash. Lookup and insert are O(1), the number
+    of remembered digests is bounded by max_size, oldest are forgotten first.'''
+
+    digest_size = 16
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.prevhash = None
+        self.digests = set()
+        self.order = collections.deque()
+        self.duplicates = 0
+        self.total_duplicates = 0
+
+    def reset(self, prevhash):
+        '''Drop all digests, called when network block changes.'''
+        if self.prevhash != None:
+            log.info("Duplicate index for %s: %d shares, %d duplicates" % \
+                     (self.prevhash, len(self.digests), self.duplicates))
+        self.prevhash = prevhash
+        self.digests = set()
+        self.order = collections.deque()
+        self.duplicates = 0
+
+    def digest(self, raw):
+        '''Compact digest of binary submission (header + nAdd)'''
+        return sha256(raw).digest()[:self.digest_size]
+
+    def register(self, key):
+        '''Registers digest of the solution. Returns False
+        when the same solution has been already registered.'''
+        if key in self.digests:
+            self.duplicates += 1
+            self.total_duplicates += 1
+            return False
+
+        if len(self.order) >= self.max_size:
+            self.digests.discard(self.order.popleft())
+
+        self.digests.add(key)
+        self.order.append(key)
+        return True
+
+    def unregister(self, key):
+        '''Forget digest of a rejected solution, so its resubmission
+        is verified again (answered by PowResultCache). The key stays
+        in eviction order, so a solution accepted on resubmission
+        can be forgotten a bit earlier than the others.'''
+        self.digests.discard(key)
+
+    def get_stats(self):
+        return {'prevhash': self.prevhash, 'shares': len(self.digests),
+                'duplicates': self.duplicates, 'total_duplicates': self.total_duplicates}
+
+    def __len__(self):
+        return len(self.digests)
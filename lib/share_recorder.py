@@ -0,0 +1,41 @@
+'''
+    Records block templates and submitted shares into a file,
+    one JSON object per line. The corpus can be replayed offline
+    by scripts/bench_submit.py for measuring the submit path.
+'''
+
+import binascii
+import simplejson as json
+
+import lib.logger
+log = lib.logger.get_logger('share_recorder')
+
+class ShareRecorder(object):
+    def __init__(self, filename):
+        self.filename = filename
+        # Line buffered, so a crash doesn't lose the tail of the recording
+        self.f = open(filename, 'a', 1)
+        log.info("Recording templates and shares to %s" % filename)
+
+    def _write(self, obj):
+        self.f.write(json.dumps(obj) + '\n')
+
+    def record_template(self, job_id, data):
+        '''data is the getblocktemplate result used for the template'''
+        self._write({'template': data, 'job_id': job_id})
+
+    def record_share(self, ctx, reason):
+        '''reason is 'valid' or message of SubmitException'''
+        self._write({
+            'label': reason,
+            'worker_name': ctx.worker_name,
+            'extranonce1': binascii.hexlify(ctx.extranonce1_bin),
+            'data': ctx.data,
+            'job_id': ctx.job_id,
+            'difficulty': ctx.difficulty,
+            'basediff': ctx.basediff,
+        })
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
@@ -0,0 +1,108 @@
+'''
+    Ordered validation stages for mining.submit.
+
+    Each stage is a callable taking ShareContext. Stage rejects the share
+    by raising SubmitException, or returns Deferred when it needs
+    to wait for something (PoW verification). Stages are ordered
+    from the cheapest to the most expensive one, so garbage
+    is rejected before we spend any real work on it.
+'''
+
+import time
+from twisted.internet import defer
+
+from lib.exceptions import SubmitException
+
+class ShareContext(object):
+    '''State of one submitted share, filled in by the pipeline stages.'''
+
+    def __init__(self, connection_ref, session, worker_name, extranonce1_bin, data, ip, submit_time):
+        self.connection_ref = connection_ref
+        self.session = session
+        self.worker_name = worker_name
+        self.extranonce1_bin = extranonce1_bin
+        self.data = data
+        self.ip = ip
+        self.submit_time = submit_time
+
+        self.header = None          # lib.share_header.ShareHeader
+        self.digest = None          # Compact digest of the solution, see DuplicateShareIndex
+        self.job = None             # lib.block_template.BlockTemplate
+        self.job_id = None
+        self.difficulty = session.get('difficulty')
+        self.basediff = session.get('basediff')
+        self.claimed_diff = None    # PoW difficulty claimed by trusted worker, see SampledVerifyPolicy
+        self.worker_stats = None    # (valid, invalid, is_banned, is_ext_diff, last_ts)
+        self.record_invalid = False # Rejection is counted as invalid share of the worker
+        self.result = None          # (block_hash_hex, share_diff, on_submit)
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.passed = 0
+        self.rejected = 0
+        self.total_time = 0.0
+
+    def add(self, elapsed, is_rejected):
+        if is_rejected:
+            self.rejected += 1
+        else:
+            self.passed += 1
+        self.total_time += elapsed
+
+    def as_dict(self):
+        count = self.passed + self.rejected
+        return {'stage': self.name, 'passed': self.passed, 'rejected': self.rejected,
+                'total_time': self.total_time,
+                'avg_time': self.total_time / count if count else 0.0}
+
+class SubmitPipeline(object):
+    def __init__(self, stages=()):
+        self.stages = []
+        self.stats = {}
+        for (name, func) in stages:
+            self.add_stage(name, func)
+
+    def add_stage(self, name, func, before=None):
+        '''Append the stage, or insert it in front of stage called before.'''
+        if name in self.stats:
+            raise Exception("Stage '%s' is already registered" % name)
+
+        index = len(self.stages)
+        if before != None:
+            index = [ n for (n, _) in self.stages ].index(before)
+
+        self.stages.insert(index, (name, func))
+        self.stats[name] = StageStats(name)
+
+    def get_stats(self):
+        return [ self.stats[name].as_dict() for (name, _) in self.stages ]
+
+    def run(self, ctx, index=0):
+        '''Pass the share through stages starting with given index.
+        Returns Deferred fired with ctx when all stages accepted the share.'''
+        for i in xrange(index, len(self.stages)):
+            (name, func) = self.stages[i]
+            start = time.time()
+            try:
+                result = func(ctx)
+            except SubmitException:
+                self.stats[name].add(time.time() - start, True)
+                raise
+
+            if isinstance(result, defer.Deferred):
+                result.addCallbacks(self._stage_done, self._stage_failed,
+                                    callbackArgs=(ctx, i, start), errbackArgs=(name, start))
+                return result
+
+            self.stats[name].add(time.time() - start, False)
+
+        return defer.succeed(ctx)
+
+    def _stage_done(self, _, ctx, index, start):
+        self.stats[self.stages[index][0]].add(time.time() - start, False)
+        return self.run(ctx, index + 1)
+
+    def _stage_failed(self, failure, name, start):
+        self.stats[name].add(time.time() - start, True)
+        return failure
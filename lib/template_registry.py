@@ -1,10 +1,8 @@
-import weakref
 import binascii
 import util
 import StringIO
 import settings
 import struct
-import gapcoin_hash
 
 from twisted.internet import defer
 from lib.exceptions import SubmitException
@@ -13,19 +11,27 @@ import lib.logger
 log = lib.logger.get_logger('template_registry')
 from mining.interfaces import Interfaces
 from extranonce_counter import ExtranonceCounter
+from worker_pool import getpowdiff
+from share_index import DuplicateShareIndex
+from pow_cache import PowResultCache
+from verify_policy import SampledVerifyPolicy
+from merkle_engine import MerkleRootEngine
+from broadcast_stats import BroadcastStats
+from job_ring import JobRing
+from share_header import ShareHeader, MIN_SHIFT, MAX_SHIFT
+from submit_pipeline import SubmitPipeline
+from share_recorder import ShareRecorder
 import lib.settings as settings
 
 
 class JobIdGenerator(object):
-    '''Generate pseudo-unique job_id. It does not need to be absolutely unique,
-    because pool sends "clean_jobs" flag to clients and they should drop all previous jobs.'''
+    '''Generate job_id, hex encoded generation of the template.
+    It never wraps, so JobRing can tell replaced job from the current one.'''
     counter = 0
     
     @classmethod
     def get_new_id(cls):
         cls.counter += 1
-        if cls.counter % 0xffff == 0:
-            cls.counter = 1
         return "%x" % cls.counter
                 
 class TemplateRegistry(object):
@@ -33,10 +39,25 @@ class TemplateRegistry(object):
     on valid block templates, provide internal interface for stratum
     service and implements block validation and submits.'''
     
-    def __init__(self, block_template_class, coinbaser, bitcoin_rpc, instance_id,
-                 on_template_callback, on_block_callback):
-        self.prevhashes = {}
-        self.jobs = weakref.WeakValueDictionary()
+    def __init__(self, block_template_class, coinbaser, bitcoin_rpc, worker_pool, instance_id,
+                 on_template_callback, on_block_callback, broadcast_pool=None):
+        self.prevhash = None
+        self.job_ring = JobRing(settings.JOB_HISTORY_SIZE, settings.JOB_GRACE_TIME)
+        self.submits = DuplicateShareIndex(settings.DUPLICATE_INDEX_SIZE)
+        self.pow_cache = PowResultCache(settings.POW_CACHE_SIZE)
+        self.verify_policy = SampledVerifyPolicy(settings.TRUSTED_WORKERS, settings.TRUSTED_IPS,
+                                                 settings.TRUSTED_SAMPLE_RATE)
+
+        # Share checks ordered from the cheapest one, PoW goes last.
+        # Job lookup is first, so later rejections count as invalid shares.
+        self.submit_pipeline = SubmitPipeline([
+            ('format', self.check_format),
+            ('job', self.check_job),
+            ('shift', self.check_shift),
+            ('ntime', self.check_ntime),
+            ('duplicate', self.check_duplicate),
+            ('pow', self.verify_pow),
+        ])
         
         self.extranonce_counter = ExtranonceCounter(instance_id)
         self.extranonce2_size = block_template_class.coinbase_transaction_class.extranonce_size \
@@ -45,15 +66,33 @@ class TemplateRegistry(object):
         self.coinbaser = coinbaser
         self.block_template_class = block_template_class
         self.bitcoin_rpc = bitcoin_rpc
+        self.worker_pool = worker_pool
+        # Separate pool keeps broadcasts out of the PoW task queue
+        if broadcast_pool == None:
+            broadcast_pool = worker_pool
+        self.merkle_engine = MerkleRootEngine(broadcast_pool, settings.MERKLE_PARALLEL_MIN_BATCH)
+        self.broadcast_stats = BroadcastStats(settings.BROADCAST_STATS_WINDOW)
+        self.update_span = None
         self.on_block_callback = on_block_callback
         self.on_template_callback = on_template_callback
         
         self.last_block = None
+        self.last_full_block = None     # Last template from getblocktemplate, not speculative
         self.update_in_progress = False
+        self.update_pending = False     # New block request came during update
+        self.pending_span = None
+        self.update_stats = {'coalesced': 0, 'followups': 0}
         self.last_update = None
+        self.last_data = None           # Last getblocktemplate result
+        self.speculative_prevhash = None
+
+        # Corpus for scripts/bench_submit.py
+        self.recorder = None
+        if settings.SHARE_RECORD_FILE:
+            self.recorder = ShareRecorder(settings.SHARE_RECORD_FILE)
         
         # Create first block template on startup
-        self.update_block()
+        self.update_block(True)
         
     def get_new_extranonce1(self):
         '''Generates unique extranonce1 (e.g. for newly
@@ -74,27 +113,24 @@ class TemplateRegistry(object):
         
         prevhash = block.prevhash_hex
 
-        if prevhash in self.prevhashes.keys():
+        if prevhash == self.prevhash:
             new_block = False
         else:
             new_block = True
-            self.prevhashes[prevhash] = []
+            self.prevhash = prevhash
+            self.submits.reset(prevhash)
+            self.pow_cache.reset(prevhash)
+
+        if block.span != None:
+            block.span.is_new_block = new_block
                
-        # Blocks sorted by prevhash, so it's easy to drop
-        # them on blockchain update
-        self.prevhashes[prevhash].append(block)
-        
-        # Weak reference for fast lookup using job_id
-        self.jobs[block.job_id] = block
+        # Templates of obsolete blocks become invalid, the oldest
+        # template is dropped from the ring
+        self.job_ring.add(block, new_block, Interfaces.timestamper.time())
         
         # Use this template for every new request
         self.last_block = block
         
-        # Drop templates of obsolete blocks
-        for ph in self.prevhashes.keys():
-            if ph != prevhash:
-                del self.prevhashes[ph]
-                
         log.info("New template for %s" % prevhash)
 
         if new_block:
@@ -109,76 +145,221 @@ class TemplateRegistry(object):
         #from twisted.internet import reactor
         #reactor.callLater(10, self.on_block_callback, new_block) 
               
-    def update_block(self):
+    def update_block(self, is_new_block=False, span=None, prevhash=None):
         '''Registry calls the getblocktemplate() RPC
-        and build new block template.'''
+        and build new block template.
+
+        is_new_block marks requests caused by a new block on the network
+        (blocknotify, found block, changed prevhash). When such request comes
+        while a fetch is in flight, exactly one follow-up fetch is done after it.
+        Merkle refreshes are satisfied by the fetch in flight.
+        span is BroadcastSpan started by the original request.
+
+        When prevhash of the new block is known, coinbase-only template
+        is broadcasted right away (see SPECULATIVE_TEMPLATES).'''
+
+        if prevhash and prevhash != self.prevhash and settings.SPECULATIVE_TEMPLATES:
+            try:
+                self.add_speculative_template(prevhash)
+            except Exception:
+                # Full template is fetched anyway
+                log.exception("Speculative template for %s failed" % prevhash)
         
         if self.update_in_progress:
-            # Block has been already detected
+            self.update_stats['coalesced'] += 1
+            if is_new_block and not self.update_pending:
+                # Fetch in flight may have started before the block was found
+                log.info("Template update in progress, new block queued")
+                self.update_pending = True
+                self.pending_span = self.broadcast_stats.start()
             return
         
         self.update_in_progress = True
         self.last_update = Interfaces.timestamper.time()
+        self.update_span = span or self.broadcast_stats.start()
         
         d = self.bitcoin_rpc.getblocktemplate()
         d.addCallback(self._update_block)
         d.addErrback(self._update_block_failed)
+        d.addBoth(self._update_block_done)
         
+    def add_speculative_template(self, prevhash):
+        '''Builds and broadcasts template with coinbase only on top of prevhash
+        from the last getblocktemplate result, so miners can leave the old
+        block before the full template is ready. Full template then comes
+        as an update of the same block. Bits are assumed unchanged, block
+        candidate is rejected by gapcoind if the difficulty changed.'''
+        if self.last_data == None:
+            return
+
+        last = self.last_data
+        data = dict(last)
+        data['previousblockhash'] = prevhash
+        data['height'] = last['height'] + 1
+        # Empty block can't claim fees of the previous template
+        data['coinbasevalue'] = last['coinbasevalue'] - sum([ t.get('fee', 0) for t in last['transactions'] ])
+        data['transactions'] = []
+        data['curtime'] = max(int(Interfaces.timestamper.time()), last['curtime'])
+
+        span = self.broadcast_stats.start()
+        template = self.block_template_class(Interfaces.timestamper, self.coinbaser, JobIdGenerator.get_new_id())
+        template.fill_from_rpc(data)
+        span.mark('template')
+        span.job_id = template.job_id
+        template.span = span
+        if self.recorder:
+            self.recorder.record_template(template.job_id, data)
+
+        log.info("Speculative template for block %d, prevhash %s" % (data['height'], prevhash))
+        self.speculative_prevhash = prevhash
+        self.add_template(template, data['height'])
+
+    def on_longpoll(self, data):
+        '''Template returned by long-poll getblocktemplate (see LongPoller)'''
+        is_new_block = data['previousblockhash'] != self.prevhash
+
+        if self.update_in_progress:
+            # Let the update in flight finish, new block gets a follow-up fetch
+            self.update_block(is_new_block)
+            return
+
+        self.update_in_progress = True
+        self.last_update = Interfaces.timestamper.time()
+        self.update_span = self.broadcast_stats.start()
+
+        d = defer.succeed(data)
+        d.addCallback(self._update_block)
+        d.addErrback(self._update_block_failed)
+        d.addBoth(self._update_block_done)
+
     def _update_block_failed(self, failure):
         log.error(str(failure))
+
+    def _update_block_done(self, result):
         self.update_in_progress = False
+
+        if self.update_pending:
+            self.update_pending = False
+            self.update_stats['followups'] += 1
+            span = self.pending_span
+            self.pending_span = None
+
+            # Latency is measured from the queued notification
+            self.update_block(True, span)
+        return result
         
     def _update_block(self, data):
+        if self.update_pending and self.speculative_prevhash == self.prevhash and \
+                data['previousblockhash'] != self.prevhash:
+            # Fetch started before the new block, speculative template
+            # is already mined and the queued follow-up replaces it
+            log.info("Dropping template of obsolete block %s" % data['previousblockhash'])
+            return data
+
         start = Interfaces.timestamper.time()
+        span = self.update_span
+        span.mark('rpc')
                 
         template = self.block_template_class(Interfaces.timestamper, self.coinbaser, JobIdGenerator.get_new_id())
-        template.fill_from_rpc(data)
+        # Speculative template has no transactions, merkle pairs
+        # are reused from the last full one
+        template.fill_from_rpc(data, self.last_full_block)
+        span.mark('template')
+        span.job_id = template.job_id
+        template.span = span
+        if self.recorder:
+            self.recorder.record_template(template.job_id, data)
+        self.last_data = data
+        self.last_full_block = template
         self.add_template(template,data['height'])
 
         log.info("Update finished, %.03f sec, %d txes" % \
                     (Interfaces.timestamper.time() - start, len(template.vtx)))
         
-        self.update_in_progress = False        
         return data
     
     def get_job(self, job_id):
         '''For given job_id returns BlockTemplate instance or None'''
-        try:
-            j = self.jobs[job_id]
-        except:
-            log.info("Job id '%s' not found" % job_id)
-            return None
-        
-        # Now we have to check if job is still valid.
-        # Unfortunately weak references are not bulletproof and
-        # old reference can be found until next run of garbage collector.
-        if j.prevhash_hex not in self.prevhashes:
-            log.info("Prevhash of job '%s' is unknown" % job_id)
-            return None
-        
-        if j not in self.prevhashes[j.prevhash_hex]:
-            log.info("Job %s is unknown" % job_id)
-            return None
-        
-        return j
-        
-    def submit_share(self, job_id, worker_name, session, extranonce1_bin, data, difficulty):
+        return self.job_ring.get(job_id, Interfaces.timestamper.time())
         
-        job = self.get_job(job_id)
-        if job == None:
-            raise SubmitException("Job '%s' not found" % job_id)
+    def submit_share(self, ctx):
+        '''Pass submitted share (ShareContext) through the validation pipeline.
+        Returns Deferred fired with ctx, ctx.result is set
+        to (block_hash_hex, share_diff, on_submit).'''
+        return self.submit_pipeline.run(ctx)
+
+    def check_format(self, ctx):
+        ctx.header = ShareHeader(ctx.data)
+
+    def check_shift(self, ctx):
+        '''Bounds of nShift and nAdd, big numbers are expensive for the primality test.
+        Pool policy (SHARE_*) can be only stricter than consensus rules.'''
+        header = ctx.header
+        if header.nShift < max(MIN_SHIFT, settings.SHARE_MIN_SHIFT) or \
+                header.nShift > min(MAX_SHIFT, settings.SHARE_MAX_SHIFT):
+            raise SubmitException("Shift out of range")
+
+        if len(header.nAdd) > settings.SHARE_MAX_ADDER_SIZE or \
+                header.adder_bits() > header.nShift:
+            raise SubmitException("Adder out of range")
+
+    def check_job(self, ctx):
+        merkle_root = ctx.header.merkle_root_hex()
+        try:
+            (ctx.job_id, ctx.difficulty, ctx.basediff, _) = \
+                Interfaces.worker_manager.job_log[ctx.extranonce1_bin][merkle_root]
+        except KeyError:
+            raise SubmitException("Job not registered!")
+
+        # From now on, rejected shares are accounted to the worker
+        ctx.record_invalid = True
+
+        ctx.job = self.get_job(ctx.job_id)
+        if ctx.job == None:
+            raise SubmitException("Job '%s' not found" % ctx.job_id)
 
-        ntime = util.flip(data[136:144])
-        if not job.check_ntime(int(ntime, 16)):
+    def check_ntime(self, ctx):
+        if not ctx.job.check_ntime(ctx.header.nTime):
             raise SubmitException("Ntime out of range")
-        
-        if not job.register_submit(data):
+
+    def check_duplicate(self, ctx):
+        ctx.digest = self.submits.digest(ctx.header.buf)
+        if not self.submits.register(ctx.digest):
             log.info("Duplicate from %s, (%s %s)" % \
-                    (worker_name, binascii.hexlify(extranonce1_bin), data))
+                    (ctx.worker_name, binascii.hexlify(ctx.extranonce1_bin), ctx.header.hex))
             raise SubmitException("Duplicate share")
-        
-        hash_int = gapcoin_hash.getpowdiff(str(data))
-        block_hash_bin = util.doublesha(binascii.unhexlify(data[0:168]))
+
+    def verify_pow(self, ctx):
+        hash_int = self.pow_cache.get(ctx.digest)
+        if hash_int != None:
+            # Low share resubmitted (proxies retry on timeout, miners
+            # after reconnect), it is not in the duplicate index
+            return self._verify_pow_done(hash_int, ctx)
+
+        if self.verify_policy.can_skip(ctx):
+            # Trusted worker, share is not in the sample
+            return self._verify_pow_done(ctx.claimed_diff, ctx)
+
+        # Primality gap check is expensive, let the worker pool do it
+        d = self.worker_pool.apply(getpowdiff, ctx.header.hex)
+        d.addErrback(self._verify_pow_failed, ctx)
+        d.addCallback(self._cache_pow, ctx)
+        d.addCallback(self._verify_pow_done, ctx)
+        return d
+
+    def _cache_pow(self, hash_int, ctx):
+        self.pow_cache.put(ctx.digest, hash_int)
+        self.verify_policy.check_claim(ctx, hash_int)
+        return hash_int
+
+    def _verify_pow_failed(self, failure, ctx):
+        log.error("PoW verification of share from %s failed: %s" % (ctx.worker_name, failure.getErrorMessage()))
+        self.submits.unregister(ctx.digest)
+        raise SubmitException("Cannot verify share")
+
+    def _verify_pow_done(self, hash_int, ctx):
+        job = ctx.job
+        block_hash_bin = util.doublesha(ctx.header.header)
         block_hash_hex = util.rev(binascii.hexlify(block_hash_bin))
 
         '''log.info("block_hash_hex %s" % block_hash_hex)
@@ -186,7 +367,10 @@ class TemplateRegistry(object):
         log.info("jobint %s" % job.target)%f
         log.info("target %s" % difficulty)'''
 
-        if hash_int < difficulty:
+        if hash_int < ctx.difficulty:
+            # Only accepted solutions stay in the duplicate index,
+            # resubmission of this one is answered from PoW cache
+            self.submits.unregister(ctx.digest)
             raise SubmitException("Share less than target")
 
         share_diff = float(float(hash_int) / float(pow(2, 48)))
@@ -195,19 +379,13 @@ class TemplateRegistry(object):
             log.info("BLOCK CANDIDATE! %s" % block_hash_hex)
 
             extranonce2_bin = struct.pack('>L', 0)
-            #self.last_block.vtx[0].set_extranonce(extranonce1_bin + extranonce2_bin) 
-            #txs = binascii.hexlify(util.ser_vector(self.last_block.vtx))
+            txs = job.serialize_block_body(ctx.extranonce1_bin, extranonce2_bin)
 
-            job.vtx[0].set_extranonce(extranonce1_bin + extranonce2_bin) 
-            txs = binascii.hexlify(util.ser_vector(job.vtx))
-            serialized = str(data) + str(txs)
-
-            on_submit = self.bitcoin_rpc.submitblock(str(data), str(txs), block_hash_hex)
+            on_submit = self.bitcoin_rpc.submitblock(ctx.header.hex, txs, block_hash_hex)
             if on_submit:
-                self.update_block()
-
-            return (block_hash_hex, share_diff, on_submit)
-        
-        return (block_hash_hex, share_diff, None)
-
+                self.update_block(True)
 
+            ctx.result = (block_hash_hex, share_diff, on_submit)
+        else:
+            ctx.result = (block_hash_hex, share_diff, None)
+        return ctx
@@ -77,16 +77,17 @@ def deser_vector(f, c):
         r.append(t)
     return r
 
+def ser_compact_size(n):
+    if n < 253:
+        return chr(n)
+    elif n < 0x10000:
+        return chr(253) + struct.pack("<H", n)
+    elif n < 0x100000000L:
+        return chr(254) + struct.pack("<I", n)
+    return chr(255) + struct.pack("<Q", n)
+
 def ser_vector(l):
-    r = ""
-    if len(l) < 253:
-        r = chr(len(l))
-    elif len(l) < 0x10000:
-        r = chr(253) + struct.pack("<H", len(l))
-    elif len(l) < 0x100000000L:
-        r = chr(254) + struct.pack("<I", len(l))
-    else:
-        r = chr(255) + struct.pack("<Q", len(l))
+    r = ser_compact_size(len(l))
     for i in l:
         r += i.serialize()
     return r
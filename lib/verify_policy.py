@@ -0,0 +1,95 @@
+'''
+    Probabilistic share verification for trusted workers (own farm
+    behind a trusted proxy). Gapcoin shares don't carry their PoW
+    difficulty, so trusted clients send it as an optional fourth
+    parameter of mining.submit. Share is credited by its claim
+    without the primality test only when:
+
+      - worker name or IP is listed in TRUSTED_WORKERS / TRUSTED_IPS,
+      - worker hasn't failed any sampled check yet,
+      - claim is below the block target (possible block is always verified),
+      - random sample didn't pick the share for full verification.
+
+    Failed sampled check drops the IP back to full verification for good
+    (until restart) and flags it. Flag is kept per IP, so switching worker
+    names doesn't restore the trust.
+'''
+
+import random
+
+import lib.logger
+log = lib.logger.get_logger('verify_policy')
+
+class SampledVerifyPolicy(object):
+    def __init__(self, workers, ips, sample_rate):
+        self.workers = set(workers)
+        self.ips = set(ips)
+        self.sample_rate = sample_rate
+        self.flagged = {}   # ip -> (worker_name, claimed_diff, hash_int)
+        self.skipped = 0
+        self.sampled = 0
+
+    def is_trusted(self, ctx):
+        if ctx.ip in self.flagged:
+            return False
+        return ctx.worker_name in self.workers or ctx.ip in self.ips
+
+    def can_skip(self, ctx):
+        '''Returns True when PoW of the share doesn't need to be verified'''
+        claim = ctx.claimed_diff
+        if claim == None or not self.is_trusted(ctx):
+            return False
+
+        if claim < ctx.difficulty or claim >= ctx.job.target:
+            # Invalid claims and block candidates are always verified
+            return False
+
+        if random.random() < self.sample_rate:
+            self.sampled += 1
+            return False
+
+        self.skipped += 1
+        return True
+
+    def check_claim(self, ctx, hash_int):
+        '''Compare verified PoW difficulty with claim of trusted worker'''
+        if ctx.claimed_diff == None or not self.is_trusted(ctx):
+            return
+
+        if hash_int < ctx.claimed_diff:
+            log.warning("Trusted worker %s IP %s claimed %d, got %d. FLAGGED, verifying all shares" % \
+                        (ctx.worker_name, ctx.ip, ctx.claimed_diff, hash_int))
+            self.flagged[ctx.ip] = (ctx.worker_name, ctx.claimed_diff, hash_int)
+
+    def get_stats(self):
+        return {'skipped': self.skipped, 'sampled': self.sampled,
+                'flagged': [ {'worker_name': w, 'ip': ip, 'claimed': c, 'verified': h}
+                             for (ip, (w, c, h)) in self.flagged.items() ]}
+
+# SampledVerifyPolicy tests
+def _test():
+    class Job(object):
+        target = 1000
+
+    class Ctx(object):
+        def __init__(self, worker_name, ip, claimed_diff):
+            self.worker_name = worker_name
+            self.ip = ip
+            self.claimed_diff = claimed_diff
+            self.difficulty = 100
+            self.job = Job()
+
+    policy = SampledVerifyPolicy(['farm.1'], ['10.0.0.1'], 0.0)
+    assert(policy.can_skip(Ctx('farm.1', '10.0.0.1', 200)))
+
+    # Sampled check failed, IP is flagged
+    policy.check_claim(Ctx('farm.1', '10.0.0.1', 200), 150)
+    assert(not policy.can_skip(Ctx('farm.1', '10.0.0.1', 200)))
+
+    # Other worker name from the same IP is not trusted either
+    assert(not policy.can_skip(Ctx('farm.2', '10.0.0.1', 200)))
+    assert(not policy.is_trusted(Ctx('farm.1', '10.0.0.1', 200)))
+    print policy.get_stats()
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,132 @@
+'''
+    Pool of worker processes for CPU heavy tasks (PoW verification,
+    merkle roots for job broadcast).
+    Results are delivered back to the reactor thread as Deferreds,
+    so the main loop is never blocked by the number crunching.
+'''
+
+import signal
+import multiprocessing
+import gapcoin_hash
+
+from hashlib import sha256
+from util import doublesha
+
+from twisted.internet import defer, reactor
+
+import lib.logger
+log = lib.logger.get_logger('worker_pool')
+
+class WorkerPoolException(Exception):
+    pass
+
+def _init_worker():
+    # Ctrl+C is handled by the main process (see DBInterface.signal_handler),
+    # workers are terminated by WorkerPool.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _run_task(func, args):
+    # Python 2 Pool.apply_async() has no error callback, so exceptions
+    # are returned as a value and re-raised in the reactor thread
+    try:
+        return (True, func(*args))
+    except Exception as e:
+        return (False, "%s: %s" % (e.__class__.__name__, str(e)))
+
+def getpowdiff(data):
+    '''Task executed inside worker process. Returns PoW difficulty
+    of given hex encoded Gapcoin block header.'''
+    return gapcoin_hash.getpowdiff(data)
+
+def merkle_roots(part1, part2, extranonce2, steps, extranonces, extranonce_size):
+    '''Task executed inside worker process. extranonces is packed buffer
+    of extranonce1 values, returns packed merkle roots (32 bytes each)
+    of coinbase part1 + extranonce1 + extranonce2 + part2 in the same order.'''
+    # Hash objects can't be pickled, SHA-256 state after part1
+    # is computed once per task instead
+    midstate = sha256(part1)
+    roots = []
+    for i in xrange(0, len(extranonces), extranonce_size):
+        h = midstate.copy()
+        h.update(extranonces[i:i + extranonce_size] + extranonce2 + part2)
+        f = sha256(h.digest()).digest()
+        for s in steps:
+            f = doublesha(f + s)
+        roots.append(f)
+    return ''.join(roots)
+
+class WorkerPool(object):
+    '''Thin wrapper around multiprocessing.Pool returning Deferreds.
+    When processes is None, pool is sized to the number of CPU cores.
+    processes = 0 runs all tasks inline in the reactor thread.
+
+    Task of a worker process which died is never answered by Python 2
+    multiprocessing.Pool, so its Deferred fails after timeout seconds
+    (None waits forever).'''
+
+    def __init__(self, processes=None, timeout=None):
+        if processes == None:
+            processes = multiprocessing.cpu_count()
+
+        self.processes = processes
+        self.timeout = timeout
+        self.pending = 0        # Tasks sent to the pool and not answered yet
+        self.timeouts = 0
+        self.pool = None
+
+        if processes > 0:
+            self.pool = multiprocessing.Pool(processes, _init_worker)
+            log.info("Started %d worker processes" % processes)
+        else:
+            log.info("Worker pool disabled, running tasks inline")
+
+    def apply(self, func, *args):
+        '''Run func(*args) in a worker process. Returns Deferred
+        which is fired in the reactor thread with the task result.'''
+        if self.pool == None:
+            return defer.maybeDeferred(func, *args)
+
+        d = defer.Deferred()
+        self.pending += 1
+
+        timeout_call = None
+        if self.timeout:
+            timeout_call = reactor.callLater(self.timeout, self._timed_out, d, func)
+
+        def _done(result):
+            # Called from the result handler thread of multiprocessing.Pool
+            reactor.callFromThread(self._finish, d, result, timeout_call)
+
+        self.pool.apply_async(_run_task, (func, args), callback=_done)
+        return d
+
+    def _finish(self, d, result, timeout_call):
+        if d.called:
+            # Timed out already
+            return
+
+        self.pending -= 1
+        if timeout_call != None:
+            timeout_call.cancel()
+
+        (is_ok, value) = result
+        if is_ok:
+            d.callback(value)
+        else:
+            d.errback(WorkerPoolException(value))
+
+    def _timed_out(self, d, func):
+        self.pending -= 1
+        self.timeouts += 1
+        log.error("Task %s not finished in %d sec, worker process died?" % (func.__name__, self.timeout))
+        d.errback(WorkerPoolException("Task timed out"))
+
+    def get_stats(self):
+        return {'processes': self.processes, 'pending': self.pending, 'timeouts': self.timeouts}
+
+    def close(self):
+        if self.pool != None:
+            log.info("Terminating worker processes")
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
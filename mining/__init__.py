@@ -24,16 +24,29 @@ def setup(on_startup):
 
     from interfaces import Interfaces
     
-    from lib.block_updater import BlockUpdater
+    from lib.block_updater import BlockUpdater, LongPoller
     from lib.template_registry import TemplateRegistry
     from lib.bitcoin_rpc import BitcoinRPC
     from lib.block_template import BlockTemplate
     from lib.coinbaser import SimpleCoinbaser
+    from lib.worker_pool import WorkerPool
+
+    # Fork worker processes for PoW verification before
+    # the RPC connection and other resources are created
+    worker_pool = WorkerPool(getattr(settings, 'WORKER_PROCESSES', None), settings.WORKER_TASK_TIMEOUT)
+    reactor.addSystemEventTrigger('before', 'shutdown', worker_pool.close)
+
+    # Broadcast has its own processes, so it doesn't queue behind shares
+    broadcast_pool = WorkerPool(getattr(settings, 'BROADCAST_WORKER_PROCESSES', None), settings.WORKER_TASK_TIMEOUT)
+    reactor.addSystemEventTrigger('before', 'shutdown', broadcast_pool.close)
 
     bitcoin_rpc = BitcoinRPC(settings.DAEMON_TRUSTED_HOST,
                              settings.DAEMON_TRUSTED_PORT,
                              settings.DAEMON_TRUSTED_USER,
-                             settings.DAEMON_TRUSTED_PASSWORD)
+                             settings.DAEMON_TRUSTED_PASSWORD,
+                             settings.DAEMON_RPC_POOL_SIZE,
+                             settings.DAEMON_RPC_TIMEOUT)
+    reactor.addSystemEventTrigger('before', 'shutdown', bitcoin_rpc.close)
 
     log.info("Connecting to RPC...")
 
@@ -55,18 +68,33 @@ def setup(on_startup):
     registry = TemplateRegistry(BlockTemplate,
                                 coinbaser,
                                 bitcoin_rpc,
+                                worker_pool,
                                 getattr(settings, 'INSTANCE_ID'),
                                 MiningSubscription.on_template,
-                                Interfaces.share_manager.on_network_block)
+                                Interfaces.share_manager.on_network_block,
+                                broadcast_pool)
     
     # Template registry is the main interface between Stratum service
     # and pool core logic
     Interfaces.set_template_registry(registry)
+    if registry.recorder:
+        reactor.addSystemEventTrigger('before', 'shutdown', registry.recorder.close)
+
+    # Worker bookkeeping (DB authorization, banning, vardiff) runs
+    # after the cheap share checks, right before PoW verification
+    from service import check_worker
+    registry.submit_pipeline.add_stage('worker', check_worker, before='pow')
     
+    # Long-poll getblocktemplate notifies about new block instantly
+    longpoller = None
+    if settings.GBT_LONGPOLL:
+        longpoller = LongPoller(registry, bitcoin_rpc)
+        longpoller.start()
+
     # Set up polling mechanism for detecting new block on the network
     # This is just failsafe solution when -blocknotify
     # mechanism is not working properly    
-    BlockUpdater(registry, bitcoin_rpc)
+    BlockUpdater(registry, bitcoin_rpc, longpoller)
 
     prune_thr = threading.Thread(target=WorkLogPruner, args=(Interfaces.worker_manager.job_log,))
     prune_thr.daemon = True
@@ -10,6 +10,7 @@ dbi = DBInterface.DBInterface()
 from twisted.internet import defer
 from mining.interfaces import Interfaces
 import time
+import math
 
 ''' This is just a customized ring buffer '''
 class SpeedBuffer:
@@ -71,6 +72,15 @@ class BasicShareLimiter(object):
         self.buffersize = self.retarget / self.target * 4
         # TODO: trim the hash of inactive workers
 
+    def get_priority(self, extranonce1_bin, basediff):
+        '''Log of estimated hashrate. Chance to find a share drops e-times
+        with every unit of difficulty, so hashrate ~ exp(basediff) / average
+        time between shares. Target time is used until the buffer fills.'''
+        stats = self.worker_stats.get(extranonce1_bin)
+        if stats == None or stats['buffer'].size() == 0:
+            return basediff - math.log(self.target)
+        return basediff - math.log(max(stats['buffer'].avg(), 1))
+
     def submit(self, connection_ref, job_id, current_difficulty, timestamp, worker_name, extranonce1_bin):
         ts = int(timestamp)
 
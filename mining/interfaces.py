@@ -63,6 +63,11 @@ class ShareLimiterInterface(object):
            - call mining.set_difficulty on connection to adjust the difficulty'''
         #return dbi.update_worker_diff(worker_name, settings.POOL_TARGET)
         return
+
+    def get_priority(self, extranonce1_bin, basediff):
+        '''Broadcast priority of the connection, higher is served first.
+        Should grow with hashrate of the connection.'''
+        return basediff
  
 class ShareManagerInterface(object):
     def __init__(self):
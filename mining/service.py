@@ -7,9 +7,8 @@ from stratum.pubsub import Pubsub
 from interfaces import Interfaces
 from subscription import MiningSubscription
 from lib.exceptions import SubmitException
+from lib.submit_pipeline import ShareContext
 import json
-import struct
-import lib.util as util
 
 import lib.logger
 log = lib.logger.get_logger('mining')
@@ -49,13 +48,24 @@ class MiningService(GenericService):
         return '%s\n' % serialized
 
     @admin
-    def update_block(self):
+    def update_block(self, block_hash=None):
         '''Connect this RPC call to 'litecoind -blocknotify' for 
         instant notification about new block on the network.
-        See blocknotify.sh in /scripts/ for more info.'''
+        See blocknotify.sh in /scripts/ for more info.
+        
+        block_hash of the new block allows broadcasting
+        of speculative template before getblocktemplate returns.'''
         
         log.info("NEW BLOCK NOTIFICATION RECEIVED!")
-        Interfaces.template_registry.update_block()
+        if block_hash != None:
+            try:
+                if len(binascii.unhexlify(block_hash)) != 32:
+                    raise TypeError
+            except (TypeError, ValueError):
+                log.warning("Ignoring invalid block hash %r" % block_hash)
+                block_hash = None
+
+        Interfaces.template_registry.update_block(True, prevhash=block_hash)
         return True 
     
     def subscribe(self, *args):
@@ -80,6 +90,7 @@ class MiningService(GenericService):
         if Interfaces.worker_manager.authorize(worker_name, worker_password):
             log.info("Worker authorized: %s IP %s" % (worker_name, str(ip)))
             session['authorized'][worker_name] = worker_password
+            session['last_activity'] = Interfaces.timestamper.time()
             is_ext_diff = False
 
             if settings.ALLOW_EXTERNAL_DIFFICULTY:
@@ -103,6 +114,7 @@ class MiningService(GenericService):
                 del Interfaces.worker_manager.worker_log['authorized'][extranonce1]
             return False
 
+    @defer.inlineCallbacks
     def request(self, *args):
         if not (self.authorize(args[0], args[1])):
             log.info("Failed worker authorization: IP %s" % str(ip))
@@ -115,30 +127,69 @@ class MiningService(GenericService):
             log.info("Connection is not subscribed for mining: IP %s" % str(ip))
             raise SubmitException("Connection is not subscribed for mining")
 
-        extranonce2 = struct.pack('>L', 0)
+        # Idle connection gets updates of the current block only on request,
+        # see MiningSubscription._snapshot
+        session['last_activity'] = Interfaces.timestamper.time()
 
-        (job_id, prevhash, version, nbits, ntime, _) = Interfaces.template_registry.get_last_broadcast_args()
+        template = Interfaces.template_registry.last_block
+        (job_id, prevhash, version, nbits, ntime, _) = template.broadcast_args
 
-        coinbase_bin = Interfaces.template_registry.last_block.serialize_coinbase(extranonce1_bin, extranonce2)
-        coinbase_hash = util.doublesha(coinbase_bin)
-        merkle_root_bin = Interfaces.template_registry.last_block.merkletree.withFirst(coinbase_hash)
+        merkle_root_bin = yield Interfaces.template_registry.merkle_engine.compute(template, [extranonce1_bin])
         merkle_root = binascii.hexlify(merkle_root_bin)       
 
+        # Client could disconnect while the merkle root was computed
+        conn = self.connection_ref()
+        if conn == None or conn.transport == None:
+            log.info("Connection closed before work was sent")
+            defer.returnValue(None)
+
         work_id = Interfaces.worker_manager.register_work(session['extranonce1'], merkle_root, session['difficulty'], job_id, session['basediff'])
         job = {}
         job['data'] = version + prevhash + merkle_root + ntime + nbits
         job['difficulty'] = session['difficulty']
 
-        return Pubsub.subscribe(self.connection_ref(), MiningSubscription(), job)
+        defer.returnValue(Pubsub.subscribe(conn, MiningSubscription(), job))
         
-    def submit(self, worker_name, password, data):
+    @admin
+    def get_submit_stats(self):
+        '''Rejection counters and timing of share validation stages,
+        duplicates caught in the current block and since start'''
+        registry = Interfaces.template_registry
+        return {'stages': registry.submit_pipeline.get_stats(),
+                'duplicates': registry.submits.get_stats()}
+
+    @admin
+    def get_broadcast_stats(self):
+        '''Phase timing of recent template broadcasts, histogram
+        of delay between block notification and job write (ms)
+        and counters of coalesced template updates'''
+        stats = Interfaces.template_registry.broadcast_stats.get_stats()
+        stats['updates'] = Interfaces.template_registry.update_stats
+        return stats
+
+    @admin
+    def get_worker_pool_stats(self):
+        '''Processes, unanswered and timed out tasks of share verification
+        and broadcast worker pools'''
+        registry = Interfaces.template_registry
+        return {'pow': registry.worker_pool.get_stats(),
+                'broadcast': registry.merkle_engine.worker_pool.get_stats()}
+
+    @admin
+    def get_trusted_stats(self):
+        '''Counters of sampled verification and flagged trusted workers'''
+        return Interfaces.template_registry.verify_policy.get_stats()
+
+    @defer.inlineCallbacks
+    def submit(self, worker_name, password, data, claimed_diff=None):
 
         session = self.connection_ref().get_session()
         session.setdefault('authorized', {})
         
-        # Check if worker is authorized to submit shares
+        # Check if worker has been authorized on this connection,
+        # authorization against DB is done later by check_worker stage
         ip = self.connection_ref()._get_ip()
-        if not Interfaces.worker_manager.authorize(worker_name, session['authorized'].get(worker_name)):
+        if worker_name not in session['authorized']:
             log.info("Worker is not authorized: IP %s" % str(ip))
             raise SubmitException("Worker is not authorized")
 
@@ -148,56 +199,32 @@ class MiningService(GenericService):
         if not extranonce1_bin:
             log.info("Connection is not subscribed for mining: IP %s" % str(ip))
             raise SubmitException("Connection is not subscribed for mining")
-        
-        # Get current block job_id
-        difficulty = session['difficulty']
-        basediff = session['basediff']
-        merkle_root = data[72:136]
-
-        if extranonce1_bin in Interfaces.worker_manager.job_log and merkle_root in Interfaces.worker_manager.job_log[extranonce1_bin]:
-            (job_id, difficulty, basediff, job_ts) = Interfaces.worker_manager.job_log[extranonce1_bin][merkle_root]
-        else:
-            raise SubmitException("Job not registered!")
-        #log.debug("worker_job_log: %s" % repr(Interfaces.worker_manager.job_log))
 
         submit_time = Interfaces.timestamper.time()
-        pool_share = settings.POOL_SHARE
-        if ((basediff - settings.POOL_TARGET)) != 0:
-            pool_share = round(pow(2, ((basediff - settings.POOL_TARGET) / 0.693147181)) * settings.POOL_SHARE)
-
-        is_ext_diff = False
-        if settings.ENABLE_WORKER_STATS:
-            (valid, invalid, is_banned, is_ext_diff, last_ts) = Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin]
-            percent = float(float(invalid) / (float(valid) if valid else 1) * 100)
-
-            if is_banned and submit_time - last_ts > settings.WORKER_BAN_TIME:
-                if percent > settings.INVALID_SHARES_PERCENT:
-                    log.info("Worker invalid percent: %0.2f %s STILL BANNED!" % (percent, worker_name))
-                else: 
-                    is_banned = False
-                    log.info("Clearing ban for worker: %s UNBANNED" %  worker_name)
-                (valid, invalid, is_banned, last_ts) = (0, 0, is_banned, Interfaces.timestamper.time())
-
-            if submit_time - last_ts > settings.WORKER_CACHE_TIME and not is_banned:
-                if percent > settings.INVALID_SHARES_PERCENT and settings.ENABLE_WORKER_BANNING:
-                    is_banned = True
-                    log.info("Worker invalid percent: %0.2f %s BANNED!" % (percent, worker_name))
-                else:
-                    log.debug("Clearing worker stats for: %s" %  worker_name)
-                (valid, invalid, is_banned, last_ts) = (0, 0, is_banned, Interfaces.timestamper.time())
+        session['last_activity'] = submit_time
+        ctx = ShareContext(self.connection_ref, session, worker_name, extranonce1_bin, data, ip, submit_time)
 
-        if settings.ENABLE_WORKER_STATS:
-            log.debug("%s (%d, %d, %s, %d) %0.2f%% job_id(%s) diff(%0.9f) share(%i)" % (worker_name, valid, invalid, is_banned, last_ts, percent, job_id, basediff, pool_share))
-        
-        if not is_ext_diff:    
-            Interfaces.share_limiter.submit(self.connection_ref, job_id, basediff, submit_time, worker_name, extranonce1_bin)
+        # Optional PoW difficulty of the share, used only for trusted workers
+        if claimed_diff != None:
+            try:
+                ctx.claimed_diff = int(claimed_diff)
+            except (TypeError, ValueError):
+                pass
 
+        recorder = Interfaces.template_registry.recorder
         try:
-            (block_hash, share_diff, on_submit) = Interfaces.template_registry.submit_share(job_id,
-                worker_name, session, extranonce1_bin, data, difficulty)
+            yield Interfaces.template_registry.submit_share(ctx)
         except SubmitException as e:
+            if recorder:
+                recorder.record_share(ctx, e[0])
+
+            if not ctx.record_invalid:
+                raise
+
             # block_header and block_hash are None when submitted data are corrupted
             if settings.ENABLE_WORKER_STATS:
+                (valid, invalid, is_banned, is_ext_diff, last_ts) = ctx.worker_stats or \
+                    Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin]
                 invalid += 1
                 if invalid > settings.INVALID_SHARES_SPAM:
                     is_banned = True
@@ -207,23 +234,73 @@ class MiningService(GenericService):
                 if is_banned:
                     raise SubmitException("Worker is temporarily banned")
  
-            Interfaces.share_manager.on_submit_share(worker_name, basediff, False, pool_share,
-                submit_time, False, ip, e[0], 0, job_id)  
+            Interfaces.share_manager.on_submit_share(worker_name, ctx.basediff, False, get_pool_share(ctx.basediff),
+                submit_time, False, ip, e[0], 0, ctx.job_id)  
             raise
 
+        if recorder:
+            recorder.record_share(ctx, 'valid')
+
+        (block_hash, share_diff, on_submit) = ctx.result
+
         if settings.ENABLE_WORKER_STATS:
+            (valid, invalid, is_banned, is_ext_diff, last_ts) = ctx.worker_stats
             valid += 1
             Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = (valid, invalid, is_banned, is_ext_diff, last_ts)
 
             if is_banned:
                 raise SubmitException("Worker is temporarily banned")
  
-        Interfaces.share_manager.on_submit_share(worker_name, basediff,
-            block_hash, pool_share, submit_time, True, ip, '', share_diff, job_id)
+        Interfaces.share_manager.on_submit_share(worker_name, ctx.basediff,
+            block_hash, get_pool_share(ctx.basediff), submit_time, True, ip, '', share_diff, ctx.job_id)
 
         if on_submit != None:
             on_submit.addCallback(Interfaces.share_manager.on_submit_block,
-                worker_name, basediff, block_hash, submit_time, ip, share_diff)
+                worker_name, ctx.basediff, block_hash, submit_time, ip, share_diff)
+
+        defer.returnValue(True)
+
+def get_pool_share(basediff):
+    pool_share = settings.POOL_SHARE
+    if ((basediff - settings.POOL_TARGET)) != 0:
+        pool_share = round(pow(2, ((basediff - settings.POOL_TARGET) / 0.693147181)) * settings.POOL_SHARE)
+    return pool_share
+
+def check_worker(ctx):
+    '''Submit pipeline stage with worker bookkeeping. It runs after
+    the cheap checks, so broken or stale shares don't cost DB lookups.'''
+
+    # Check if worker is authorized to submit shares
+    if not Interfaces.worker_manager.authorize(ctx.worker_name, ctx.session['authorized'].get(ctx.worker_name)):
+        log.info("Worker is not authorized: IP %s" % str(ctx.ip))
+        ctx.record_invalid = False
+        raise SubmitException("Worker is not authorized")
+
+    worker_name = ctx.worker_name
+    submit_time = ctx.submit_time
+    is_ext_diff = False
+    if settings.ENABLE_WORKER_STATS:
+        (valid, invalid, is_banned, is_ext_diff, last_ts) = Interfaces.worker_manager.worker_log['authorized'][ctx.extranonce1_bin]
+        percent = float(float(invalid) / (float(valid) if valid else 1) * 100)
+
+        if is_banned and submit_time - last_ts > settings.WORKER_BAN_TIME:
+            if percent > settings.INVALID_SHARES_PERCENT:
+                log.info("Worker invalid percent: %0.2f %s STILL BANNED!" % (percent, worker_name))
+            else: 
+                is_banned = False
+                log.info("Clearing ban for worker: %s UNBANNED" %  worker_name)
+            (valid, invalid, is_banned, last_ts) = (0, 0, is_banned, Interfaces.timestamper.time())
+
+        if submit_time - last_ts > settings.WORKER_CACHE_TIME and not is_banned:
+            if percent > settings.INVALID_SHARES_PERCENT and settings.ENABLE_WORKER_BANNING:
+                is_banned = True
+                log.info("Worker invalid percent: %0.2f %s BANNED!" % (percent, worker_name))
+            else:
+                log.debug("Clearing worker stats for: %s" %  worker_name)
+            (valid, invalid, is_banned, last_ts) = (0, 0, is_banned, Interfaces.timestamper.time())
 
-        return True
+        ctx.worker_stats = (valid, invalid, is_banned, is_ext_diff, last_ts)
+        log.debug("%s (%d, %d, %s, %d) %0.2f%% job_id(%s) diff(%0.9f) share(%i)" % (worker_name, valid, invalid, is_banned, last_ts, percent, ctx.job_id, ctx.basediff, get_pool_share(ctx.basediff)))
         
+    if not is_ext_diff:    
+        Interfaces.share_limiter.submit(ctx.connection_ref, ctx.job_id, ctx.basediff, submit_time, worker_name, ctx.extranonce1_bin)
@@ -1,8 +1,8 @@
+from twisted.internet import task
 from stratum.pubsub import Pubsub, Subscription
 from mining.interfaces import Interfaces
-import struct
 import binascii
-import lib.util as util
+import weakref
 import lib.settings as settings
 import lib.logger
 log = lib.logger.get_logger('subscription')
@@ -14,44 +14,169 @@ class MiningSubscription(Subscription):
     
     event = 'mining.notify'
     
+    # CooperativeTask of running broadcast
+    broadcast = None
+
+    # New block broadcast was not finished yet, it is carried over
+    # to the template replacing it, so idle connections get the new block
+    new_block_pending = False
+
+    # Weak references to subscriptions in order of the previous broadcast,
+    # used when BROADCAST_PRIORITY is 'presorted'
+    order = None
+
     @classmethod
     def on_template(cls, is_new_block):
         '''This is called when TemplateRegistry registers
            new block which we have to broadcast clients.'''
         
+        if cls.broadcast != None:
+            # Previous template is not fully broadcasted yet,
+            # there is no reason to finish it
+            try:
+                cls.broadcast.stop()
+                log.info("Broadcast of previous template interrupted")
+            except task.TaskDone:
+                pass
+            cls.broadcast = None
+
+        # Replaced broadcast (or the one still waiting for merkle roots)
+        # could be a new block one
+        is_new_block = is_new_block or cls.new_block_pending
+        cls.new_block_pending = is_new_block
+
         start = Interfaces.timestamper.time()
-        clean_jobs = is_new_block
-        
-        (job_id, prevhash, version, nbits, ntime, _) = Interfaces.template_registry.get_last_broadcast_args()     
+        template = Interfaces.template_registry.last_block
 
-        # Push new job to subscribed clients
+        # Subscribers can come and go during the broadcast, take a snapshot
+        # of authorized ones
+        subscribers = cls._snapshot(is_new_block)
+
+        # Merkle roots for all connections are computed by worker processes
+        d = Interfaces.template_registry.merkle_engine.compute(template,
+                [ session['extranonce1'] for (_, session) in subscribers ])
+        d.addCallback(cls._start_broadcast, template, subscribers, start)
+        d.addErrback(cls._broadcast_failed)
+
+    @classmethod
+    def _authorized(cls, subscription, idle_since=None):
+        conn = subscription.connection_ref()
+        if conn == None:
+            return None
+        session = conn.get_session()
+        if not session.get('authorized') or not session.get('extranonce1'):
+            return None
+
+        if idle_since != None and session.get('last_activity', 0) < idle_since:
+            # Idle connection keeps its job of the current block,
+            # new work is built on its next mining.request
+            return None
+        return (subscription, session)
+
+    @classmethod
+    def _priority(cls, pair):
+        session = pair[1]
+        return Interfaces.share_limiter.get_priority(session['extranonce1'], session.get('basediff', 0))
+
+    @classmethod
+    def _snapshot(cls, is_new_block=False):
+        '''Returns authorized subscribers as (subscription, session),
+        ordered according to BROADCAST_PRIORITY setting.
+
+        Idle connections are left out only on updates of the current block,
+        new block (clean_jobs) is pushed to everybody.'''
+        priority = settings.BROADCAST_PRIORITY
+        idle_since = None
+        if settings.LAZY_WORK_IDLE_TIME and not is_new_block:
+            idle_since = Interfaces.timestamper.time() - settings.LAZY_WORK_IDLE_TIME
+
+        if priority == 'presorted' and cls.order != None:
+            # Order was computed after the previous broadcast,
+            # connections subscribed since then go last
+            subscribers = []
+            seen = set()
+            for ref in cls.order:
+                subscription = ref()
+                if subscription == None:
+                    continue
+                seen.add(id(subscription))
+                pair = cls._authorized(subscription, idle_since)
+                if pair != None:
+                    subscribers.append(pair)
+
+            for subscription in Pubsub.iterate_subscribers(cls.event):
+                if id(subscription) not in seen:
+                    pair = cls._authorized(subscription, idle_since)
+                    if pair != None:
+                        subscribers.append(pair)
+            return subscribers
+
+        subscribers = []
         for subscription in Pubsub.iterate_subscribers(cls.event):
-            try:
-                if subscription != None:
-                    session = subscription.connection_ref().get_session()
-                    session.setdefault('authorized', {})
-                    if session['authorized'].keys():
-                        worker_name = session['authorized'].keys()[0]
-                        extranonce1 = session.get('extranonce1', None)
-                        extranonce2 = struct.pack('>L', 0)        
-                        coinbase_bin = Interfaces.template_registry.last_block.serialize_coinbase(extranonce1, extranonce2)
-                        coinbase_hash = util.doublesha(coinbase_bin)
-                        merkle_root_bin = Interfaces.template_registry.last_block.merkletree.withFirst(coinbase_hash)
-                        merkle_root = binascii.hexlify(merkle_root_bin)
-                        job = {}
-                        job['data'] = version + prevhash + merkle_root + ntime + nbits
-                        job['difficulty'] = session['difficulty']
-                        work_id = Interfaces.worker_manager.register_work(extranonce1, merkle_root, session['difficulty'], job_id, session['basediff']) 
-                        subscription.emit_single(job)            
-                    else:
-                        continue
-                  
-            except Exception as e:
-                log.exception("Error broadcasting work to client %s" % str(e))
-                pass
+            pair = cls._authorized(subscription, idle_since)
+            if pair != None:
+                subscribers.append(pair)
+
+        if priority in ('hashrate', 'presorted'):
+            # Biggest miners get the new job first
+            subscribers.sort(key=cls._priority, reverse=True)
+        return subscribers
+
+    @classmethod
+    def _broadcast_failed(cls, failure):
+        log.error("Broadcast failed: %s" % failure.getErrorMessage())
+
+    @classmethod
+    def _start_broadcast(cls, merkle_roots, template, subscribers, start):
+        if template is not Interfaces.template_registry.last_block:
+            # Newer template arrived while computing merkle roots
+            return
+
+        log.debug("Merkle roots for %d connections in %.03f sec" % \
+                  (len(subscribers), Interfaces.timestamper.time() - start))
+        if template.span != None:
+            template.span.mark('merkle')
+
+        # Broadcast in chunks, reactor serves other connections between them
+        cls.broadcast = task.cooperate(cls._broadcast(template, subscribers, merkle_roots, start))
+
+    @classmethod
+    def _broadcast(cls, template, subscribers, merkle_roots, start):
+        chunk_size = settings.BROADCAST_CHUNK_SIZE
+
+        # Push new job to subscribed clients
+        for i in xrange(0, len(subscribers), chunk_size):
+            chunk_start = Interfaces.timestamper.time()
+            for j in xrange(i, min(i + chunk_size, len(subscribers))):
+                (subscription, session) = subscribers[j]
+                merkle_root = binascii.hexlify(merkle_roots[j * 32:(j + 1) * 32])
+                cls._push_job(subscription, session, merkle_root, template)
+
+            log.debug("Broadcasted chunk %d-%d in %.03f sec" % \
+                      (i, i + chunk_size, Interfaces.timestamper.time() - chunk_start))
+            yield None
         
-        cnt = Pubsub.get_subscription_count(cls.event)
-        log.info("BROADCASTED to %d connections in %.03f sec" % (cnt, (Interfaces.timestamper.time() - start)))
+        log.info("BROADCASTED to %d connections in %.03f sec" % (len(subscribers), (Interfaces.timestamper.time() - start)))
+        cls.new_block_pending = False
+        if template.span != None:
+            Interfaces.template_registry.broadcast_stats.finish(template.span)
+
+        if settings.BROADCAST_PRIORITY == 'presorted':
+            # Sort for the next broadcast while nothing is waiting for it
+            subscribers = sorted(subscribers, key=cls._priority, reverse=True)
+            cls.order = [ weakref.ref(sub) for (sub, _) in subscribers ]
+
+    @classmethod
+    def _push_job(cls, subscription, session, merkle_root, template):
+        try:
+            work_id = Interfaces.worker_manager.register_work(session['extranonce1'], merkle_root, session['difficulty'], template.job_id, session['basediff']) 
+            # Response is spliced into template's pre-rendered JSON
+            subscription.emit_serialized(template.render_notify(merkle_root, session['difficulty']))
+            if template.span != None:
+                template.span.add_latency()
+              
+        except Exception as e:
+            log.exception("Error broadcasting work to client %s" % str(e))
         
     def _finish_after_subscribe(self, result):
         return result
@@ -62,3 +187,66 @@ class MiningSubscription(Subscription):
         the subscription request and client receive messages in wrong order.'''
         self.connection_ref().on_finish.addCallback(self._finish_after_subscribe)
 
+def _test():
+    class Pending(object):
+        # Merkle roots never computed, broadcast stays unfinished
+        def addCallback(self, *args):
+            return self
+        addErrback = addCallback
+
+    class MerkleEngine(object):
+        computed = []
+        def compute(self, template, extranonces):
+            self.computed.append(extranonces)
+            return Pending()
+
+    class Registry(object):
+        class last_block(object):
+            job_id = '1f'
+        merkle_engine = MerkleEngine()
+
+    class Connection(object):
+        def __init__(self, session):
+            self.session = session
+        def get_session(self):
+            return self.session
+
+    class Sub(object):
+        def __init__(self, session):
+            self.conn = Connection(session)
+        def connection_ref(self):
+            return self.conn
+
+    idle = {'authorized': True, 'extranonce1': '\0' * 4, 'last_activity': 0}
+    active = {'authorized': True, 'extranonce1': '\1' * 4, 'last_activity': 10000}
+    subs = [Sub(idle), Sub(active)]
+
+    Interfaces.timestamper = type('T', (object,), {'time': lambda self: 10000})()
+    Interfaces.template_registry = Registry()
+    settings.LAZY_WORK_IDLE_TIME = 60
+    settings.BROADCAST_PRIORITY = None
+    iterate = Pubsub.__dict__['iterate_subscribers']
+    Pubsub.iterate_subscribers = classmethod(lambda cls, event: iter(subs))
+    computed = MerkleEngine.computed
+    try:
+        # Update of the current block skips the idle connection
+        assert [ s for (_, s) in MiningSubscription._snapshot(False) ] == [active]
+
+        # New block is pushed to the idle connection as well
+        assert [ s for (_, s) in MiningSubscription._snapshot(True) ] == [idle, active]
+
+        # Update replacing unfinished new block broadcast is new block too
+        MiningSubscription.on_template(True)
+        MiningSubscription.on_template(False)
+        assert computed == [['\0' * 4, '\1' * 4]] * 2
+
+        # Once new block is broadcasted, updates skip idle connection again
+        MiningSubscription.new_block_pending = False
+        MiningSubscription.on_template(False)
+        assert computed[2] == ['\1' * 4]
+    finally:
+        Pubsub.iterate_subscribers = iterate
+    print "OK"
+
+if __name__ == '__main__':
+    _test()
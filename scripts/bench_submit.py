@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# Offline benchmark of the mining.submit path.
+#
+# Replays a corpus recorded with SHARE_RECORD_FILE (see config) against
+# block templates stored in the same corpus (or loaded by --template from
+# a saved getblocktemplate JSON). No gapcoind and no MySQL are needed,
+# but gapcoin_hash and twisted have to be installed.
+#
+#   python scripts/bench_submit.py shares.log
+#   python scripts/bench_submit.py --template gbt.json --repeat 5 shares.log
+#
+# Reports shares/sec, p50/p99 latency of every pipeline stage
+# and net number of GC tracked objects left per share (objects allocated
+# and not freed while garbage collection is disabled, not all allocations).
+
+import os
+import sys
+import gc
+import time
+import types
+import weakref
+import logging
+import argparse
+import binascii
+import simplejson as json
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path = [os.path.join(root, 'conf'), root] + sys.path
+
+class StubDB(object):
+    '''Stands for mining.DBInterface, accepts everything, stores nothing'''
+    def init_main(self): pass
+    def set_bitcoinrpc(self, bitcoinrpc): pass
+    def check_password(self, username, password): return True
+    def get_user(self, username): return []
+    def update_worker_diff(self, username, diff): pass
+    def queue_share(self, data): pass
+    def found_block(self, data): pass
+
+stub = types.ModuleType('mining.DBInterface')
+stub.DBInterface = StubDB
+sys.modules['mining.DBInterface'] = stub
+
+from twisted.internet import defer
+
+import lib.settings as settings
+settings.SHARE_RECORD_FILE = None
+settings.WORKER_PROCESSES = 0
+
+from mining.interfaces import Interfaces, WorkerManagerInterface, ShareManagerInterface, \
+                              ShareLimiterInterface, PredictableTimestamperInterface
+from mining.service import MiningService, check_worker
+from lib.template_registry import TemplateRegistry
+from lib.block_template import BlockTemplate
+from lib.worker_pool import WorkerPool
+from lib.exceptions import SubmitException
+
+class StubRPC(object):
+    def __init__(self):
+        self.template = None
+
+    def getblocktemplate(self):
+        return defer.succeed(self.template)
+
+    def submitblock(self, block_hex, txs, block_hash_hex):
+        return defer.succeed(True)
+
+class StubCoinbaser(object):
+    def get_script_pubkey(self):
+        return '\x76\xa9\x14' + '\x00' * 20 + '\x88\xac'
+
+    def get_coinbase_data(self):
+        return ''
+
+class BenchConnection(object):
+    def __init__(self, extranonce1_bin):
+        self.session = {'extranonce1': extranonce1_bin, 'authorized': {}}
+
+    def get_session(self):
+        return self.session
+
+    def _get_ip(self):
+        return '127.0.0.1'
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+class Bench(object):
+    def __init__(self, corpus, template):
+        self.rpc = StubRPC()
+        self.connections = {}
+        self.job_ids = {}       # recorded job_id -> replayed job_id
+        self.timings = {}
+        self.outcomes = {}
+        self.mismatches = 0
+        self.shares = 0
+        self.corpus = corpus
+
+        Interfaces.set_timestamper(PredictableTimestamperInterface())
+        Interfaces.set_worker_manager(WorkerManagerInterface())
+        Interfaces.set_share_manager(ShareManagerInterface())
+        Interfaces.set_share_limiter(ShareLimiterInterface())
+
+        first = template or self._first_template()
+        Interfaces.timestamper.start_time = first['curtime']
+        self.rpc.template = first
+
+        self.registry = TemplateRegistry(BlockTemplate, StubCoinbaser(), self.rpc, WorkerPool(0),
+                                         settings.INSTANCE_ID, lambda is_new_block: None,
+                                         Interfaces.share_manager.on_network_block)
+        Interfaces.set_template_registry(self.registry)
+        self.registry.submit_pipeline.add_stage('worker', check_worker, before='pow')
+        self._wrap_stages()
+
+    def _first_template(self):
+        for entry in self.corpus:
+            if 'template' in entry:
+                return entry['template']
+        raise Exception("Corpus contains no template, use --template")
+
+    def _wrap_stages(self):
+        pipeline = self.registry.submit_pipeline
+        for i, (name, func) in enumerate(pipeline.stages):
+            self.timings[name] = []
+            pipeline.stages[i] = (name, self._timed(name, func))
+
+    def _timed(self, name, func):
+        samples = self.timings[name]
+        def inner(ctx):
+            start = time.time()
+            try:
+                return func(ctx)
+            finally:
+                samples.append(time.time() - start)
+        return inner
+
+    def load_template(self, entry):
+        self.rpc.template = entry['template']
+        self.registry.update_in_progress = False
+        self.registry.update_block()
+        self.job_ids[entry.get('job_id')] = self.registry.last_block.job_id
+
+    def get_connection(self, entry):
+        extranonce1_bin = binascii.unhexlify(entry['extranonce1'])
+        conn = self.connections.get(extranonce1_bin)
+        if conn == None:
+            conn = BenchConnection(extranonce1_bin)
+            self.connections[extranonce1_bin] = conn
+            Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = \
+                (0, 0, False, False, Interfaces.timestamper.time())
+
+        conn.session['authorized'][entry['worker_name']] = ''
+        conn.session['difficulty'] = entry['difficulty']
+        conn.session['basediff'] = entry['basediff']
+
+        # Emulate register_work() of the job the share was mined on
+        job_id = self.job_ids.get(entry['job_id'], 'unknown')
+        if entry['job_id'] != None:
+            merkle_root = entry['data'][72:136].lower()
+            Interfaces.worker_manager.job_log.setdefault(extranonce1_bin, {})[merkle_root] = \
+                (job_id, entry['difficulty'], entry['basediff'], Interfaces.timestamper.time())
+        return conn
+
+    def submit(self, entry):
+        conn = self.get_connection(entry)
+        service = MiningService()
+        service.connection_ref = weakref.ref(conn)
+
+        result = []
+        d = service.submit(entry['worker_name'], '', entry['data'])
+        d.addCallbacks(lambda _: result.append('valid'),
+                       lambda f: result.append(f.value[0] if f.check(SubmitException) else repr(f.value)))
+
+        outcome = result[0]
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        if outcome != entry['label']:
+            self.mismatches += 1
+        self.shares += 1
+
+    def run(self, repeat):
+        gc.collect()
+        gc.disable()
+        survived = gc.get_count()[0]
+        start = time.time()
+
+        for _ in xrange(repeat):
+            # Every round starts with fresh duplicate index
+            self.registry.submits.reset(None)
+            for entry in self.corpus:
+                if 'template' in entry:
+                    self.load_template(entry)
+                else:
+                    self.submit(entry)
+
+        elapsed = time.time() - start
+        survived = gc.get_count()[0] - survived
+        gc.enable()
+        return (elapsed, survived)
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded shares through mining.submit.')
+    parser.add_argument('corpus', type=str, help='file recorded with SHARE_RECORD_FILE')
+    parser.add_argument('--template', dest='template', type=str, default=None,
+                        help='getblocktemplate JSON used before the first template of the corpus')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1, help='replay the corpus N times')
+    args = parser.parse_args()
+
+    # Keep logging out of the measurements
+    logging.disable(logging.INFO)
+
+    corpus = [ json.loads(line) for line in open(args.corpus) if line.strip() ]
+    template = None
+    if args.template:
+        template = json.load(open(args.template))
+        if 'result' in template:
+            template = template['result']
+
+    bench = Bench(corpus, template)
+    (elapsed, survived) = bench.run(args.repeat)
+
+    print "Shares:       %d in %.03f sec, %.01f shares/sec" % (bench.shares, elapsed, bench.shares / elapsed if elapsed else 0)
+    print "GC objects:   %.01f net GC tracked objects left per share" % (float(survived) / bench.shares if bench.shares else 0)
+    print "Mismatches:   %d shares with different result than recorded" % bench.mismatches
+    print
+    print "%-12s %8s %12s %12s" % ('stage', 'calls', 'p50 (ms)', 'p99 (ms)')
+    for (name, _) in bench.registry.submit_pipeline.stages:
+        samples = bench.timings[name]
+        print "%-12s %8d %12.03f %12.03f" % (name, len(samples), percentile(samples, 50) * 1000, percentile(samples, 99) * 1000)
+    print
+    for (outcome, count) in sorted(bench.outcomes.items(), key=lambda x: -x[1]):
+        print "%8d  %s" % (count, outcome)
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@
 # Send notification to Stratum mining instance on localhost that there's new bitcoin block
 # You can use this script directly as an variable for -blocknotify argument:
 # 	./litecoind -blocknotify="blocknotify.sh --password admin_password"
+# With --block %s the pool can start mining on the new block before
+# it gets the full block template:
+# 	./gapcoind -blocknotify="blocknotify.sh --password admin_password --block %s"
 # This is also very basic example how to use Stratum protocol in native Python
 
 import socket
@@ -16,6 +19,7 @@ parser = argparse.ArgumentParser(description='Send notification to Stratum insta
 parser.add_argument('--password', dest='password', type=str, help='admin password from Stratum server config')
 parser.add_argument('--host', dest='host', type=str, default='localhost', help='hostname of Stratum mining instance')
 parser.add_argument('--port', dest='port', type=int, default=3333, help='port of Stratum mining instance')
+parser.add_argument('--block', dest='block', type=str, default=None, help='hash of the new block (%%s of -blocknotify)')
 
 args = parser.parse_args()
 
@@ -23,7 +27,10 @@ if args.password == None:
 	parser.print_help()
 	sys.exit()
 	
-message = {'id': 1, 'method': 'mining.update_block', 'params': [args.password]}
+params = [args.password]
+if args.block:
+    params.append(args.block)
+message = {'id': 1, 'method': 'mining.update_block', 'params': params}
 
 try:
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -77,6 +77,14 @@ SSL_CACERT = 'server.crt'
 # Full specification: http://haproxy.1wt.eu/download/1.5/doc/proxy-protocol.txt
 TCP_PROXY_PROTOCOL = False
 
+# Join messages written to one connection within one reactor iteration
+# (e.g. share response, new difficulty and new job) into a single write.
+# Off by default: Twisted TCP transport buffers writes of one iteration
+# and sends them together anyway, so this only saves the per-message
+# transport.write() calls and costs a callLater per connection. Enable
+# for transports writing to the socket immediately.
+WRITE_COALESCING = False
+
 # ******************** HTTP SETTINGS *****************
 
 # Keepalive for HTTP transport sessions (at this time for both poll and push)
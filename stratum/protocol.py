@@ -72,6 +72,13 @@ class Protocol(LineOnlyReceiver):
         
         # Initiate connection session
         self.session = {}
+
+        # Messages waiting for flush_writes(), see transport_write().
+        # Enabled only by socket transport, HTTP transport collects
+        # the output before the request finishes.
+        self.write_coalescing = self.factory.__dict__.get('write_coalescing', False)
+        self.write_buffer = []
+        self.flush_call = None
         
         stats.PeerStats.client_connected(self._get_ip())
         log.debug("Connected %s" % self.transport.getPeer().host)
@@ -79,7 +86,26 @@ class Protocol(LineOnlyReceiver):
     
     def transport_write(self, data):
         '''Overwrite this if transport needs some extra care about data written
-        to the socket, like adding message format in websocket.''' 
+        to the socket, like adding message format in websocket.
+        
+        With write coalescing, messages produced within one reactor
+        iteration are joined and written to the transport at once.''' 
+        if not self.write_coalescing:
+            self.transport.write(data)
+            return
+
+        self.write_buffer.append(data)
+        if self.flush_call == None:
+            self.flush_call = reactor.callLater(0, self.flush_writes)
+
+    def flush_writes(self):
+        self.flush_call = None
+        if self.transport == None or not self.write_buffer:
+            self.write_buffer = []
+            return
+
+        data = ''.join(self.write_buffer)
+        self.write_buffer = []
         self.transport.write(data)
         
         
@@ -88,6 +114,11 @@ class Protocol(LineOnlyReceiver):
             self.on_disconnect.callback(self)
             self.on_disconnect = None
  
+        if self.flush_call != None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.write_buffer = []
+
         stats.PeerStats.client_disconnected(self._get_ip())
         connection_registry.ConnectionRegistry.remove_connection(self)
         self.transport = None # Fixes memory leak (cyclic reference)
@@ -99,6 +130,13 @@ class Protocol(LineOnlyReceiver):
 
         self.transport_write("%s\n" % serialized)
  
+    def writeSerialized(self, serialized):
+        '''Write message pre-rendered by the caller, including delimiter'''
+        if self.factory.debug:
+            log.debug("protocol < %s" % serialized.rstrip())
+
+        self.transport_write(serialized)
+
     def writeJsonRequest(self, method, params, is_notification=False):
         request_id = None if is_notification else self._get_id() 
         serialized = json.dumps({'id': request_id, 'method': method, 'params': params})
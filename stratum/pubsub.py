@@ -69,6 +69,16 @@ class Subscription(object):
             else:
                 raise Exception("Return object from process() method must be list or None")
 
+    def emit_serialized(self, serialized):
+        '''Write already serialized message (including line delimiter)
+        to current subscription, process() is not called.'''
+        conn = self.connection_ref()
+        if conn == None:
+            # Connection is closed
+            return
+
+        conn.writeSerialized(serialized)
+
     def emit_new_block(self, *args, **kwargs):
         '''Perform emit of this event just for current subscription.'''
         conn = self.connection_ref()
@@ -73,7 +73,8 @@ def setup_finalize(event, application):
                                                                         signing_key=signing_key,
                                                                         signing_id=settings.SIGNING_ID,
                                                                         event_handler=ServiceEventHandler,
-                                                                        tcp_proxy_protocol_enable=settings.TCP_PROXY_PROTOCOL))
+                                                                        tcp_proxy_protocol_enable=settings.TCP_PROXY_PROTOCOL,
+                                                                        write_coalescing=settings.WRITE_COALESCING))
         socket.setServiceParent(application)
 
     # Build the HTTP interface
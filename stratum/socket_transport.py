@@ -16,7 +16,7 @@ def sockswrapper(proxy, dest):
   
 class SocketTransportFactory(ServerFactory):
     def __init__(self, debug=False, signing_key=None, signing_id=None, event_handler=GenericEventHandler,
-                 tcp_proxy_protocol_enable=False):
+                 tcp_proxy_protocol_enable=False, write_coalescing=False):
         self.debug = debug
         self.signing_key = signing_key
         self.signing_id = signing_id
@@ -25,6 +25,9 @@ class SocketTransportFactory(ServerFactory):
         
         # Read settings.TCP_PROXY_PROTOCOL documentation
         self.tcp_proxy_protocol_enable = tcp_proxy_protocol_enable
+
+        # Read settings.WRITE_COALESCING documentation
+        self.write_coalescing = write_coalescing
         
 class SocketTransportClientFactory(ReconnectingClientFactory):
     def __init__(self, host, port, allow_trusted=True, allow_untrusted=False,